@@ -32,13 +32,25 @@ strict_pgs
 
 import os
 import re
+import sys
+import copy
 import time
 import fcntl
 import errno
-import shutil
-import pathlib
+import stat
+import mmap
+import bisect
+import struct
+import asyncio
+import random
+import tempfile
+import itertools
+import threading
+import collections
+import contextlib
+import contextvars
+import concurrent.futures
 from passlib import hosts
-from datetime import datetime
 
 __author__ = "fpemud@sina.com (Fpemud)"
 __version__ = "0.0.1"
@@ -49,6 +61,10 @@ MUSER_SET_SHELL = 2
 MUSER_JOIN_GROUP = 3
 MUSER_LEAVE_GROUP = 4
 
+FSYNC_NONE = 1              # don't fsync, fastest, a crash may lose the latest commit or leave an empty file
+FSYNC_PER_FILE = 2          # fsync every file and the directory after each file is replaced
+FSYNC_PER_COMMIT = 3        # fsync every file before replacing, fsync the directory once after all files are replaced
+
 
 class PgsFormatError(Exception):
     pass
@@ -70,6 +86,380 @@ class PgsAddUserToGroupError(Exception):
     pass
 
 
+class PgsConflictError(Exception):
+    pass
+
+
+class PgsCdbExportError(Exception):
+    pass
+
+
+# a problem found by PasswdGroupShadow.check()
+#   stage:   1, 2 or 3, same as the stages of verify()
+#   fixable: whether close() in writable mode fixes it
+#   entity:  name of the user or group involved, None if the problem is not about a single user or group
+#   message: same as the message of PgsFormatError raised by verify()
+PgsVerifyProblem = collections.namedtuple("PgsVerifyProblem", ["stage", "fixable", "entity", "message"])
+
+
+# process wide cache of parsed and verified state for read-only instances
+# key: real path of dirPrefix; value: (file identity, state dict), least recently used first
+_stateCache = collections.OrderedDict()
+_stateCacheLock = threading.Lock()
+_stateCacheSize = 8
+
+
+def clearStateCache():
+    """drop all the state cached for PasswdGroupShadow(..., useCache=True)"""
+    with _stateCacheLock:
+        _stateCache.clear()
+
+
+def _stateCacheGet(key, fileIdentity):
+    with _stateCacheLock:
+        if key not in _stateCache:
+            return None
+        if _stateCache[key][0] != fileIdentity:
+            del _stateCache[key]
+            return None
+        _stateCache.move_to_end(key)
+        return _stateCache[key][1]
+
+
+def _stateCachePut(key, fileIdentity, state):
+    with _stateCacheLock:
+        _stateCache[key] = (fileIdentity, state)
+        _stateCache.move_to_end(key)
+        while len(_stateCache) > _stateCacheSize:
+            _stateCache.popitem(last=False)
+
+
+# key: filename; value: ((inode, mtime, size), dict of all the keys)
+_loginDefsCache = dict()
+_loginDefsCacheLock = threading.Lock()
+
+
+def getLoginDefs(filename="/etc/login.defs"):
+    """Returns all the keys in login.defs as a dict.
+       Values are converted to int (decimal, octal with leading 0 or hex with leading 0x) or bool (yes/no),
+       others are kept as str. Parsed result is cached until the inode, mtime or size of the file changes."""
+
+    st = os.stat(filename)
+    identity = (st.st_ino, st.st_mtime_ns, st.st_size)
+    with _loginDefsCacheLock:
+        if filename in _loginDefsCache and _loginDefsCache[filename][0] == identity:
+            return dict(_loginDefsCache[filename][1])
+
+    ret = dict()
+    with open(filename) as f:
+        for line in f:
+            t = line.split(None, 1)
+            if len(t) == 0 or t[0].startswith("#"):
+                continue
+            key = t[0]
+            value = t[1].strip() if len(t) > 1 else ""
+            if len(value) >= 2 and value.startswith('"') and value.endswith('"'):
+                value = value[1:-1]
+            ret[key] = _loginDefsValue(value)
+
+    with _loginDefsCacheLock:
+        _loginDefsCache[filename] = (identity, ret)
+    return dict(ret)
+
+
+def _loginDefsValue(value):
+    if re.fullmatch(r'0[xX][0-9a-fA-F]+', value):
+        return int(value, 16)
+    if re.fullmatch(r'0[0-7]+', value):
+        return int(value, 8)
+    if re.fullmatch(r'-?[0-9]+', value):
+        return int(value)
+    if value.lower() == "yes":
+        return True
+    if value.lower() == "no":
+        return False
+    return value
+
+
+def _statFileList(filenameList):
+    ret = []
+    for fn in filenameList:
+        try:
+            st = os.stat(fn)
+            ret.append((st.st_ino, st.st_mtime_ns, st.st_size))
+        except FileNotFoundError:
+            ret.append(None)
+    return tuple(ret)
+
+
+def _cdbHash(key):
+    h = 5381
+    for c in key:
+        h = ((h << 5) + h) ^ c
+    return h & 0xffffffff
+
+
+def _cdbBuild(itemList):
+    """returns the content of a cdb file, itemList is a list of (key, value) strings"""
+
+    buf = [b"\0" * 2048]
+    pos = 2048
+    bucketList = [[] for i in range(0, 256)]
+    for key, value in itemList:
+        key = key.encode("utf-8")
+        value = value.encode("utf-8")
+        h = _cdbHash(key)
+        bucketList[h & 0xff].append((h, pos))
+        buf.append(struct.pack("<LL", len(key), len(value)))
+        buf.append(key)
+        buf.append(value)
+        pos += 8 + len(key) + len(value)
+
+    header = []
+    for bucket in bucketList:
+        # hash table with twice the slots of the records, linear probing
+        n = len(bucket) * 2
+        slotList = [(0, 0)] * n
+        for h, p in bucket:
+            i = (h >> 8) % n
+            while slotList[i][1] != 0:
+                i = (i + 1) % n
+            slotList[i] = (h, p)
+        header.append(pos)
+        header.append(n)
+        buf.append(b"".join(struct.pack("<LL", h, p) for h, p in slotList))
+        pos += n * 8
+    if pos >= 2 ** 32:
+        raise PgsFormatError("Too much data for cdb file")
+
+    buf[0] = struct.pack("<512L", *header)
+    return b"".join(buf)
+
+
+class _CdbReader:
+    """read a cdb file through mmap, see PasswdGroupShadow.exportCdb()"""
+
+    def __init__(self, filename):
+        with open(filename, "rb") as f:
+            if os.fstat(f.fileno()).st_size < 2048:
+                raise PgsFormatError("Invalid cdb file %s" % (filename))
+            self.buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def close(self):
+        self.buf.close()
+
+    def get(self, key, default=None):
+        """returns the value of the first record of key"""
+        key = key.encode("utf-8")
+        h = _cdbHash(key)
+        tpos, tlen = struct.unpack_from("<LL", self.buf, (h & 0xff) * 8)
+        if tlen == 0:
+            return default
+        i = (h >> 8) % tlen
+        for j in range(0, tlen):
+            sh, spos = struct.unpack_from("<LL", self.buf, tpos + i * 8)
+            if spos == 0:
+                break
+            if sh == h:
+                klen, dlen = struct.unpack_from("<LL", self.buf, spos)
+                if self.buf[spos + 8:spos + 8 + klen] == key:
+                    return self.buf[spos + 8 + klen:spos + 8 + klen + dlen].decode("utf-8")
+            i = (i + 1) % tlen
+        return default
+
+
+class _EncryptedPassword:
+    """encrypted password (or a future of it) recorded in the operation log, it is used as is when the operation is replayed"""
+
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+
+def _encryptPassword(password, scheme=None, rounds=None):
+    # module level function so that it can be run in worker processes
+    if scheme is None:
+        return hosts.linux_context.encrypt(password)
+    handler = hosts.linux_context.handler(scheme)
+    if rounds is not None:
+        handler = handler.using(rounds=rounds)
+    return handler.hash(password)
+
+
+class _OrderedSet:
+
+    """Insertion ordered set, membership test, append and removal are O(1).
+       Equality is order sensitive.
+    """
+
+    def __init__(self, iterable=[]):
+        self._d = dict.fromkeys(iterable)
+
+    def append(self, x):
+        self._d[x] = None
+
+    def remove(self, x):
+        del self._d[x]
+
+    def discard(self, x):
+        self._d.pop(x, None)
+
+    def sort(self, key=None):
+        self._d = dict.fromkeys(sorted(self._d, key=key))
+
+    def getOrder(self):
+        """returns a copy of the elements and their order, which can be given to setOrder() later"""
+        return dict(self._d)
+
+    def setOrder(self, order):
+        self._d = order
+
+    def __contains__(self, x):
+        return x in self._d
+
+    def __iter__(self):
+        return iter(self._d)
+
+    def __reversed__(self):
+        return reversed(self._d)
+
+    def __len__(self):
+        return len(self._d)
+
+    def __eq__(self, other):
+        if not isinstance(other, _OrderedSet):
+            return NotImplemented
+        return len(self._d) == len(other._d) and all(a == b for a, b in zip(self._d, other._d))
+
+    def __repr__(self):
+        return "_OrderedSet(%r)" % (list(self._d))
+
+
+class _IdAllocator:
+
+    """Free ids in [idMin, idMax), kept as sorted disjoint half-open intervals.
+       Finding the lowest free id is O(1). Reserving and releasing an id finds the interval in O(log k) by bisect,
+       but splitting or merging intervals inserts into or deletes from the lists, which is O(k), k being the number
+       of free intervals. k stays small as ids are allocated lowest first and holes are reused.
+    """
+
+    def __init__(self, idMin, idMax):
+        self.idMin = idMin
+        self.idMax = idMax
+        if idMin < idMax:
+            self._starts = [idMin]
+            self._ends = [idMax]
+        else:
+            self._starts = []
+            self._ends = []
+
+    def isFree(self, id):
+        i = bisect.bisect_right(self._starts, id) - 1
+        return i >= 0 and id < self._ends[i]
+
+    def first(self):
+        """returns the lowest free id, None if there's no free id"""
+        if len(self._starts) == 0:
+            return None
+        return self._starts[0]
+
+    def firstCommon(self, other):
+        """returns the lowest id which is free in both allocators, None if there's no such id"""
+        i = 0
+        j = 0
+        while i < len(self._starts) and j < len(other._starts):
+            s = max(self._starts[i], other._starts[j])
+            if s < self._ends[i] and s < other._ends[j]:
+                return s
+            if self._ends[i] <= other._ends[j]:
+                i += 1
+            else:
+                j += 1
+        return None
+
+    def reserve(self, id):
+        """mark id as used, do nothing if id is out of range or already used"""
+        i = bisect.bisect_right(self._starts, id) - 1
+        if i < 0 or id >= self._ends[i]:
+            return
+        s, e = self._starts[i], self._ends[i]
+        if s == id and e == id + 1:
+            del self._starts[i]
+            del self._ends[i]
+        elif s == id:
+            self._starts[i] = id + 1
+        elif e == id + 1:
+            self._ends[i] = id
+        else:
+            self._ends[i] = id
+            self._starts.insert(i + 1, id + 1)
+            self._ends.insert(i + 1, e)
+
+    def release(self, id):
+        """mark id as free, do nothing if id is out of range or already free"""
+        if not (self.idMin <= id < self.idMax):
+            return
+        i = bisect.bisect_right(self._starts, id) - 1
+        if i >= 0 and id < self._ends[i]:
+            return
+        mergeLeft = (i >= 0 and self._ends[i] == id)
+        mergeRight = (i + 1 < len(self._starts) and self._starts[i + 1] == id + 1)
+        if mergeLeft and mergeRight:
+            self._ends[i] = self._ends[i + 1]
+            del self._starts[i + 1]
+            del self._ends[i + 1]
+        elif mergeLeft:
+            self._ends[i] = id + 1
+        elif mergeRight:
+            self._starts[i + 1] = id
+        else:
+            self._starts.insert(i + 1, id)
+            self._ends.insert(i + 1, id + 1)
+
+
+class _SubIdAllocator:
+
+    """Free aligned slots of subordinate ids in [subIdMin, subIdMax), every slot has subIdCount ids.
+       Slots are tracked by index with an _IdAllocator, so holes are reused lowest first.
+       Ranges which are not a valid slot are never tracked.
+    """
+
+    def __init__(self, subIdMin, subIdMax, subIdCount):
+        self.subIdMin = subIdMin
+        self.subIdMax = subIdMax
+        self.subIdCount = subIdCount
+        self._slots = _IdAllocator(0, (subIdMax - subIdMin) // subIdCount)
+
+    def isValid(self, start, count):
+        return self.subIdMin <= start < self.subIdMax and (start - self.subIdMin) % self.subIdCount == 0 and count == self.subIdCount
+
+    def allocate(self):
+        """reserve the lowest free slot and returns its start, None if there's no free slot"""
+        i = self._slots.first()
+        if i is None:
+            return None
+        self._slots.reserve(i)
+        return self.subIdMin + i * self.subIdCount
+
+    def isFree(self, start, count):
+        return self.isValid(start, count) and self._slots.isFree((start - self.subIdMin) // self.subIdCount)
+
+    def reserve(self, start, count):
+        if self.isValid(start, count):
+            self._slots.reserve((start - self.subIdMin) // self.subIdCount)
+
+    def release(self, start, count):
+        if self.isValid(start, count):
+            self._slots.release((start - self.subIdMin) // self.subIdCount)
+
+
 class PasswdGroupShadow:
 
     """Unix account files with special format and rules.
@@ -84,87 +474,161 @@ class PasswdGroupShadow:
 
     class _PwdEntry:
 
-        def __init__(self, *kargs):
-            if len(kargs) == 1:
-                fields = kargs[0]
-                assert len(fields) == 7
-                self.pw_name = fields[0]
-                self.pw_passwd = fields[1]
-                self.pw_uid = int(fields[2])
-                self.pw_gid = int(fields[3])
-                self.pw_gecos = fields[4]
-                self.pw_dir = fields[5]
-                self.pw_shell = fields[6]
-            elif len(kargs) == 7:
-                assert isinstance(kargs[2], int) and isinstance(kargs[3], int)
-                self.pw_name = kargs[0]
-                self.pw_passwd = kargs[1]
-                self.pw_uid = kargs[2]
-                self.pw_gid = kargs[3]
-                self.pw_gecos = kargs[4]
-                self.pw_dir = kargs[5]
-                self.pw_shell = kargs[6]
-            else:
-                assert False
+        __slots__ = ("pw_name", "pw_passwd", "pw_uid", "pw_gid", "pw_gecos", "pw_dir", "pw_shell")
+
+        def __init__(self, pw_name, pw_passwd, pw_uid, pw_gid, pw_gecos, pw_dir, pw_shell):
+            self.pw_name = pw_name
+            self.pw_passwd = pw_passwd
+            self.pw_uid = pw_uid
+            self.pw_gid = pw_gid
+            self.pw_gecos = pw_gecos
+            self.pw_dir = pw_dir
+            self.pw_shell = pw_shell
 
     class _GrpEntry:
 
-        def __init__(self, *kargs):
-            if len(kargs) == 1:
-                fields = kargs[0]
-                assert len(fields) == 4
-                self.gr_name = fields[0]
-                self.gr_passwd = fields[1]
-                self.gr_gid = int(fields[2])
-                self.gr_mem = fields[3]
-            elif len(kargs) == 4:
-                assert isinstance(kargs[2], int)
-                self.gr_name = kargs[0]
-                self.gr_passwd = kargs[1]
-                self.gr_gid = kargs[2]
-                self.gr_mem = kargs[3]
-            else:
-                assert False
+        __slots__ = ("gr_name", "gr_passwd", "gr_gid")
+
+        def __init__(self, gr_name, gr_passwd, gr_gid):
+            self.gr_name = gr_name
+            self.gr_passwd = gr_passwd
+            self.gr_gid = gr_gid
 
     class _ShadowEntry:
 
-        def __init__(self, *kargs):
-            if len(kargs) == 1:
-                fields = kargs[0]
-                assert len(fields) == 9
-                self.sh_name = fields[0]
-                self.sh_encpwd = fields[1]
-            elif len(kargs) == 9:
-                self.sh_name = kargs[0]
-                self.sh_encpwd = kargs[1]
-                assert kargs[2] == ""
-                assert kargs[3] == ""
-                assert kargs[4] == ""
-                assert kargs[5] == ""
-                assert kargs[6] == ""
-                assert kargs[7] == ""
-                assert kargs[8] == ""
-            else:
-                assert False
+        __slots__ = ("sh_name", "sh_encpwd")
+
+        def __init__(self, sh_name, sh_encpwd):
+            # other fields are always empty
+            self.sh_name = sh_name
+            self.sh_encpwd = sh_encpwd
 
     class _SubUidGidEntry:
 
+        __slots__ = ("name", "start", "count")
+
         def __init__(self, name, start, count):
             self.name = name
             self.start = start
             self.count = count
 
+    # passlib scheme for ENCRYPT_METHOD in login.defs, the default scheme of passlib is used for others
+    _encryptMethodDict = {
+        "SHA512": "sha512_crypt",
+        "SHA256": "sha256_crypt",
+        "MD5": "md5_crypt",
+        "DES": "des_crypt",
+    }
+
     _stdSystemUserList = ["root", "nobody"]
     _stdDeprecatedUserList = ["bin", "daemon", "adm", "shutdown", "halt", "operator", "lp"]
     _stdSystemGroupList = ["root", "nobody", "nogroup", "wheel", "users"]
     _stdDeviceGroupList = ["tty", "disk", "lp", "mem", "kmem", "floppy", "console", "audio", "cdrom", "tape", "video", "cdrw", "usb", "plugdev", "input", "kvm"]
     _stdDeprecatedGroupList = ["bin", "daemon", "sys", "adm"]
 
-    def __init__(self, dirPrefix="/", readOnly=True, msrc="strict_pgs"):
+    # all the tables, which are written to the account files of the same name
+    _tableList = ["passwd", "group", "shadow", "gshadow", "subuid", "subgid"]
+
+    # interval between attempts of acquiring the lock, in seconds
+    _lockIntervalMin = 0.001
+    _lockIntervalMax = 0.1
+
+    # maximum number of re-parsing in snapshot mode
+    _snapshotRetries = 10
+
+    # argument of queryUsers() and queryGroups(), and the corresponding list attributes
+    _userCategoryDict = {
+        "system": "systemUserList",
+        "normal": "normalUserList",
+        "software": "softwareUserList",
+        "deprecated": "deprecatedUserList",
+    }
+    _groupCategoryDict = {
+        "system": "systemGroupList",
+        "device": "deviceGroupList",
+        "per-user": "perUserGroupList",
+        "stand-alone": "standAloneGroupList",
+        "software": "softwareGroupList",
+        "deprecated": "deprecatedGroupList",
+    }
+
+    # format version of the exported cdb files
+    _cdbVersion = "3"
+
+    # attributes filled by _parseLoginDef
+    _loginDefAttrList = [
+        "loginDefs", "uidMin", "uidMax", "gidMin", "gidMax",
+        "subUidMin", "subUidMax", "subUidCount", "subGidMin", "subGidMax", "subGidCount",
+    ]
+
+    # tables which can be parsed lazily, and the attributes created by parsing them
+    _lazyTableAttrDict = {
+        "shadow": ["shadowEntryList", "shDict"],
+        "subuid": ["subUidEntryList", "subUidDict", "subUidAllocator"],
+        "subgid": ["subGidEntryList", "subGidDict", "subGidAllocator"],
+    }
+
+    # attributes which make up the parsed state, they are shared with the cache and copied by _detachState()
+    _stateAttrList = [
+        "systemUserList", "normalUserList", "softwareUserList", "deprecatedUserList", "pwdDict", "uidAllocator", "uidDict", "dupUidSet",
+        "systemGroupList", "deviceGroupList", "perUserGroupList", "standAloneGroupList", "softwareGroupList", "deprecatedGroupList",
+        "grpDict", "gidAllocator", "gidDict", "dupGidSet", "groupMemberDict", "userGroupDict", "groupMemberFlawSet",
+        "shadowEntryList", "shDict", "pendingPwdSet",
+        "subUidEntryList", "subUidDict", "subUidAllocator",
+        "subGidEntryList", "subGidDict", "subGidAllocator",
+        "dirtySet", "verifiedOk", "touchedUserSet", "touchedGroupSet",
+    ]
+
+    def __init__(self, dirPrefix="/", readOnly=True, msrc="strict_pgs", hashWorkers=0, fsyncPolicy=FSYNC_PER_COMMIT, useCache=False, lazy=False, lockTimeout=15.0, snapshot=False, optimistic=False, cdbExport=False):
+        """hashWorkers: number of worker processes used to encrypt passwords, 0 means encrypting inline.
+                        With worker processes addNormalUser() and modifyNormalUser(MUSER_SET_PASSWORD) don't
+                        wait for the encryption, results are collected by verify(), batch() or close().
+           fsyncPolicy: one of FSYNC_NONE, FSYNC_PER_FILE and FSYNC_PER_COMMIT. Account files are always written
+                        to temporary files and renamed into place, this decides how durable a commit is.
+           useCache:    only for read-only mode. Parsed and verified state is shared with other instances in this
+                        process as long as inode, mtime and size of all the account files are not changed.
+                        The state is copied when a shared instance is modified.
+           lazy:        shadow, subuid and subgid are parsed when they are first needed or before the first modification,
+                        instead of in the constructor.
+                        Querying users and groups only reads passwd and group then, which doesn't need root privilege.
+           lockTimeout: only for writable mode. Seconds to wait for the lock held by other processes, 0 means no waiting.
+                        PgsLockError is raised when it expires. self.lockWaitTime and self.lockRetries record the contention.
+           snapshot:    only for read-only mode, can't be used with lazy. The lock is not taken, instead inode, mtime and size
+                        of all the account files are compared before and after parsing, and parsing is retried if any of
+                        them changed, so that a commit of another process is either fully seen or not seen at all.
+           optimistic:  only for writable mode, can't be used with lazy. The lock is not taken when parsing, but only when
+                        committing, so parsing is done the same way as in snapshot mode. If account files were changed by
+                        other processes since parsing, they are parsed again and the modifications done on this object are
+                        replayed on the new state, PgsConflictError is raised if the replay fails.
+                        Passwords are not encrypted again when replaying.
+           cdbExport:   only for writable mode. Export passwd and group to cdb files after every commit, see exportCdb().
+                        The commit is kept if exporting fails, PgsCdbExportError is raised after it."""
+
+        assert not snapshot or (readOnly and not lazy)
+        assert not optimistic or (not readOnly and not lazy)
+        assert not cdbExport or not readOnly
+
         self.valid = True
+        self.inBatch = False
+        self.sharedState = False
         self.dirPrefix = dirPrefix
         self.readOnly = readOnly
         self.manageFlag = "# manged by %s" % (msrc)
+        self.hashWorkers = hashWorkers
+        self.hashExecutor = None
+        self.fsyncPolicy = fsyncPolicy
+        self.pendingWriteList = []              # (temporary file, account file) written but not renamed yet
+        self.optimistic = optimistic
+        self.cdbExport = cdbExport
+        self.baseIdentity = None                # identity of account files which the state is parsed from or committed to, see _statFiles()
+        self.opLog = []                         # (method name, arguments) of modifications not committed yet, in optimistic mode
+        self.modified = False                   # the state is modified after parsing, so it doesn't reflect the account files
+        self.undoLog = None                     # (function, arguments) which undo the modifications done in batch(), see _undoable()
+        self.undoOrderSet = None                # ids of the _OrderedSet whose order is already saved in undoLog
+
+        # tables which may differ from their file, all of them are unknown before the first commit
+        self.dirtySet = set(self._tableList)
+        self.filesUnknown = False               # a failed commit left account files which can't be trusted, see _restoreFiles()
 
         self.loginDefFile = os.path.join(dirPrefix, "etc", "login.defs")
         self.passwdFile = os.path.join(dirPrefix, "etc", "passwd")
@@ -173,11 +637,18 @@ class PasswdGroupShadow:
         self.gshadowFile = os.path.join(dirPrefix, "etc", "gshadow")
         self.subuidFile = os.path.join(dirPrefix, "etc", "subuid")
         self.subgidFile = os.path.join(dirPrefix, "etc", "subgid")
+        self.passwdCdbFile = os.path.join(dirPrefix, "etc", "passwd.cdb")
+        self.groupCdbFile = os.path.join(dirPrefix, "etc", "group.cdb")
 
         self.lockFile = os.path.join(dirPrefix, "etc", ".pwd.lock")
         self.lockFd = None
+        self.lockTimeout = lockTimeout
+        self.lockWaitTime = 0.0                 # seconds spent in acquiring the lock
+        self.lockRetries = 0                    # failed attempts before the lock is acquired
+        self.snapshotRetries = 0                # re-parsing caused by concurrent modification in snapshot mode
 
         # filled by _parseLoginDef
+        self.loginDefs = None                   # all the keys in login.defs, see getLoginDefs()
         self.uidMin = -1
         self.uidMax = -1
         self.gidMin = -1
@@ -189,52 +660,97 @@ class PasswdGroupShadow:
         self.subGidMax = -1
         self.subGidCount = -1
 
-        # filled by _parsePasswd
-        self.systemUserList = []
-        self.normalUserList = []
-        self.softwareUserList = []
-        self.deprecatedUserList = []
-        self.pwdDict = dict()                   # key: username; value: _PwdEntry
-
-        # filled by _parseGroup
-        self.systemGroupList = []
-        self.deviceGroupList = []
-        self.perUserGroupList = []
-        self.standAloneGroupList = []
-        self.softwareGroupList = []
-        self.deprecatedGroupList = []
-        self.secondaryGroupsDict = dict()       # key: username; value: secondary group list of that user
-        self.grpDict = dict()                   # key: groupname; value: _GrpEntry
-
-        # filled by _parseShadow
-        self.shadowEntryList = []
-        self.shDict = dict()                    # key: username; value: _ShadowEntry
-
-        # filled by _parseSubUid
-        self.subUidEntryList = []
-        self.subUidDict = dict()                # key: username; value: _SubUidGidEntry
-
-        # filled by _parseSubGid
-        self.subGidEntryList = []
-        self.subGidDict = dict()                # key: username; value: _SubUidGidEntry
-
-        # do parsing
-        self._parseLoginDef()
-        if not self.readOnly:
-            self._lockPwd()
+        # other attributes of the parsed state are created by _parsePasswd, _parseGroup, _parseShadow, _parseSubUid and _parseSubGid
+        self.pendingPwdSet = set()              # usernames whose sh_encpwd is still a future
+        self.lazyTableSet = set()               # tables not parsed yet in lazy mode, see __getattr__()
+        self.verifiedOk = False                 # all the stages of verify() passed before touching the entities below
+        self.touchedUserSet = set()             # users added, removed or modified since construction or the last passed verify()
+        self.touchedGroupSet = set()            # stand-alone groups added or removed since construction or the last passed verify()
+
+        # indexes for queries, built when first needed and dropped when the indexed fields may be changed
+        self.shellIndex = None                  # key: login shell; value: set of usernames
+        self.homeIndex = None                   # sorted list of (home directory, username)
+        self.secondaryGroupsCache = dict()      # key: username; value: sorted list of groupnames which has the user as member
+        self.subUidIndex = None                 # (starts, ends, usernames, running maximum of ends), sorted by start
+        self.subGidIndex = None                 # same as above
+
+        # use cached state
+        if useCache and self.readOnly:
+            cacheKey = os.path.realpath(dirPrefix)
+            fileIdentity = self._statFiles()
+            state = _stateCacheGet(cacheKey, fileIdentity)
+            if state is not None:
+                self._restoreState(state)
+                self.lazyTableSet = set(state["lazyTableSet"])
+                self.sharedState = True
+                self.baseIdentity = fileIdentity
+                if not lazy:
+                    # the cached state may come from a lazy instance, parse and verify what it doesn't have
+                    for table in list(self.lazyTableSet):
+                        self._loadTable(table)
+                return
+
+        # do parsing and verify, the lock is not held in optimistic mode, so files are parsed the same way as in snapshot mode
+        if snapshot or optimistic:
+            self._parseSnapshot()
+        else:
+            self._parseLoginDef()
+            if not self.readOnly and not self.optimistic:
+                self._lockPwd()
+            self.baseIdentity = self._statFiles()
+            try:
+                self._parseFiles(lazy)
+            except Exception:
+                if not self.readOnly and not self.optimistic:
+                    self._unlockPwd()
+                raise
+            self._verifyStage1()
+
+        # save state into cache, files modified during parsing make the state inconsistent
+        if useCache and self.readOnly:
+            if self._statFiles() == fileIdentity:
+                state = {k: self.__dict__[k] for k in self._loginDefAttrList + self._stateAttrList if k in self.__dict__}
+                state["lazyTableSet"] = set(self.lazyTableSet)
+                _stateCachePut(cacheKey, fileIdentity, state)
+                self.sharedState = True
+
+    def __getattr__(self, name):
+        # only called when name is not found, which is the case for attributes of a table not parsed yet in lazy mode
+        for table, attrList in self._lazyTableAttrDict.items():
+            if name in attrList and table in self.__dict__.get("lazyTableSet", []):
+                self._loadTable(table)
+                return self.__dict__[name]
+        raise AttributeError("'%s' object has no attribute '%s'" % (self.__class__.__name__, name))
+
+    @classmethod
+    def openMapped(cls, dirPrefix="/"):
+        """Open the cdb files exported by exportCdb() through mmap, returns a MappedPasswdGroupShadow, which does no
+           parsing and decodes entries when they are accessed, so it opens in constant time and the data is shared
+           by all the processes through page cache.
+           Falls back to PasswdGroupShadow(dirPrefix, lazy=True) if the cdb files are missing or out of date, so the
+           caller should only use the methods supported by both:
+             get*List(), getSecondaryGroupsOfUser(), queryUsers(), queryGroups(), getUserByUid(), getGroupByGid(),
+             resolveUids(), resolveGids(), close()
+           Subordinate ids are not exported, ownerOfSub*(), findSub*Overlaps(), verify() and check() of
+           MappedPasswdGroupShadow raise NotImplementedError."""
         try:
-            self._parsePasswd()
-            self._parseGroup(self.normalUserList)
-            self._parseShadow()
-            self._parseSubUid()
-            self._parseSubGid()
-        except Exception:
-            if not self.readOnly:
-                self._unlockPwd()
-            raise
+            ret = MappedPasswdGroupShadow(dirPrefix)
+        except (FileNotFoundError, PgsFormatError):
+            return cls(dirPrefix, lazy=True)
+        if ret.isOutOfDate():
+            ret.close()
+            return cls(dirPrefix, lazy=True)
+        return ret
 
-        # do verify
-        self._verifyStage1()
+    @classmethod
+    def tryOpen(cls, dirPrefix="/", **kwargs):
+        """Open in writable mode without waiting for the lock, returns None if the lock is held by another process."""
+        kwargs["readOnly"] = False
+        kwargs["lockTimeout"] = 0
+        try:
+            return cls(dirPrefix, **kwargs)
+        except PgsLockError:
+            return None
 
     def __enter__(self):
         return self
@@ -245,259 +761,831 @@ class PasswdGroupShadow:
     def getSystemUserList(self):
         """returns system user name list"""
         assert self.valid
-        return self.systemUserList
+        return list(self.systemUserList)
 
     def getNormalUserList(self):
         """returns normal user name list"""
         assert self.valid
-        return self.normalUserList
+        return list(self.normalUserList)
 
     def getSystemGroupList(self):
         """returns system group name list"""
         assert self.valid
-        return self.systemGroupList
+        return list(self.systemGroupList)
 
     def getStandAloneGroupList(self):
         """returns stand-alone group name list"""
         assert self.valid
-        return self.standAloneGroupList
+        return list(self.standAloneGroupList)
 
     def getSoftwareGroupList(self):
         """returns software group name list"""
         assert self.valid
-        return self.softwareGroupList
+        return list(self.softwareGroupList)
 
     def getSecondaryGroupsOfUser(self, username):
         """returns group name list"""
         assert self.valid
         assert username in self.normalUserList
-        return sorted(self.secondaryGroupsDict.get(username, []))
+        if username not in self.secondaryGroupsCache:
+            self.secondaryGroupsCache[username] = sorted(self.userGroupDict.get(username, []))
+        return list(self.secondaryGroupsCache[username])
+
+    def queryUsers(self, category=None, shell=None, homePrefix=None, groups=None, anyGroups=None):
+        """Returns the set of user names which match all the specified conditions:
+             category:   "system", "normal", "software" or "deprecated"
+             shell:      login shell
+             homePrefix: home directory starts with it, use "/srv/" instead of "/srv" for users under /srv
+             groups:     member of all of these groups
+             anyGroups:  member of any of these groups
+           Group membership is the member field in /etc/group, primary group is not included.
+           All the users are returned if no condition is specified, use set operations to combine results."""
+        assert self.valid
+
+        candidateList = []
+        if category is not None:
+            candidateList.append(getattr(self, self._userCategoryDict[category]))
+        if shell is not None:
+            candidateList.append(self._getShellIndex().get(shell, set()))
+        if homePrefix is not None:
+            candidateList.append(self._queryHomePrefix(homePrefix))
+        if groups is not None:
+            for gname in groups:
+                candidateList.append(self.groupMemberDict.get(gname, set()))
+        if anyGroups is not None:
+            unionSet = set()
+            for gname in anyGroups:
+                unionSet.update(self.groupMemberDict.get(gname, []))
+            candidateList.append(unionSet)
+        if groups is not None or anyGroups is not None:
+            # the member field may have names which are not users
+            candidateList.append(self.pwdDict)
+        return self._intersect(candidateList, self.pwdDict)
+
+    def queryGroups(self, category=None, member=None):
+        """Returns the set of group names which match all the specified conditions:
+             category: "system", "device", "per-user", "stand-alone", "software" or "deprecated"
+             member:   has this user in member field
+           All the groups are returned if no condition is specified, use set operations to combine results."""
+        assert self.valid
+
+        candidateList = []
+        if category is not None:
+            candidateList.append(getattr(self, self._groupCategoryDict[category]))
+        if member is not None:
+            candidateList.append(self.userGroupDict.get(member, set()))
+        return self._intersect(candidateList, self.grpDict)
+
+    def getUserByUid(self, uid):
+        """returns user name, None if not found"""
+        assert self.valid
+        return self.uidDict.get(uid)
+
+    def getGroupByGid(self, gid):
+        """returns group name, None if not found"""
+        assert self.valid
+        return self.gidDict.get(gid)
+
+    def resolveUids(self, uids):
+        """returns a dict which maps every uid to its user name, None for uid not found"""
+        assert self.valid
+        return {x: self.uidDict.get(x) for x in uids}
+
+    def resolveGids(self, gids):
+        """returns a dict which maps every gid to its group name, None for gid not found"""
+        assert self.valid
+        return {x: self.gidDict.get(x) for x in gids}
+
+    def ownerOfSubUid(self, id):
+        """returns name of the user whose subordinate user id range contains id, None if not found"""
+        assert self.valid
+        ret = self._findSubIdOverlaps(self._getSubUidIndex(), id, 1, True)
+        return ret[0] if len(ret) > 0 else None
+
+    def ownerOfSubGid(self, id):
+        """returns name of the user whose subordinate group id range contains id, None if not found"""
+        assert self.valid
+        ret = self._findSubIdOverlaps(self._getSubGidIndex(), id, 1, True)
+        return ret[0] if len(ret) > 0 else None
+
+    def findSubUidOverlaps(self, start, count):
+        """returns the set of user names whose subordinate user id range overlaps [start, start + count)"""
+        assert self.valid
+        return set(self._findSubIdOverlaps(self._getSubUidIndex(), start, count, False))
+
+    def findSubGidOverlaps(self, start, count):
+        """returns the set of user names whose subordinate group id range overlaps [start, start + count)"""
+        assert self.valid
+        return set(self._findSubIdOverlaps(self._getSubGidIndex(), start, count, False))
 
     def verify(self):
-        """check account files according to the critiera"""
+        """Check account files according to the critiera.
+           After a passed verify(), only the users and groups touched since then are checked again."""
+        assert self.valid
+        self._waitPasswords()
+        if self.verifiedOk:
+            self._raiseFirst(self._checkStage1Touched())
+            self._verifyStage2()
+            self._raiseFirst(self._checkStage3Touched())
+        else:
+            self._verifyStage1()
+            self._verifyStage2()
+            self._verifyStage3()
+        self._setAttr(self, "verifiedOk", True)
+        self._setAttr(self, "touchedUserSet", set())
+        self._setAttr(self, "touchedGroupSet", set())
+
+    def check(self):
+        """Check account files according to the critiera like verify(), but doesn't stop at the first problem.
+           Returns a list of PgsVerifyProblem for all the problems found, empty list means verify() would pass."""
         assert self.valid
-        self._verifyStage1()
-        self._verifyStage2()
-        self._verifyStage3()
+        self._waitPasswords()
+        ret = []
+        for stage, problemIter in [(1, self._checkStage1()), (2, self._checkStage2())]:
+            for entity, message in problemIter:
+                ret.append(PgsVerifyProblem(stage, False, entity, message))
+        for entity, message, fixable in self._checkStage3():
+            ret.append(PgsVerifyProblem(3, fixable, entity, message))
+        return ret
 
     def addNormalUser(self, username, password):
         assert self.valid
+        self._detachState()
         assert username not in self.pwdDict
         assert username not in self.grpDict
 
-        # generate user id
-        newUid = 1000
-        while True:
-            if newUid >= 10000:
-                raise PgsAddUserError("Can not find a valid user id")
-            if newUid in [v.pw_uid for v in self.pwdDict.values()]:
-                newUid += 1
-                continue
-            if newUid in [v.gr_gid for v in self.grpDict.values()]:
-                newUid += 1
-                continue
-            break
+        # generate user id, it is also used as the group id of the per-user group
+        newUid = self.uidAllocator.firstCommon(self.gidAllocator)
+        if newUid is None:
+            raise PgsAddUserError("Can not find a valid user id")
+
+        # reserve subordinate id ranges before changing any table, so that nothing is changed if there's no free range
+        subUidStart = self._allocateSubIds(self.subUidAllocator)
+        if subUidStart is None:
+            raise PgsAddUserError("Can not find a valid subordinate user id range")
+        subGidStart = self._allocateSubIds(self.subGidAllocator)
+        if subGidStart is None:
+            self._releaseSubIds(self.subUidAllocator, subUidStart, self.subUidCount)
+            raise PgsAddUserError("Can not find a valid subordinate group id range")
+        self._reserveId(self.uidAllocator, newUid)
+        self._reserveId(self.gidAllocator, newUid)
 
         # add user
-        self.pwdDict[username] = self._PwdEntry(username, "x", newUid, newUid, "", "/home/%s" % (username), "/bin/bash")
-        self.normalUserList.append(username)
+        self._setItem(self.pwdDict, username, self._PwdEntry(username, "x", newUid, newUid, "", "/home/%s" % (username), "/bin/bash"))
+        self._listAppend(self.normalUserList, username)
+        self._setItem(self.uidDict, newUid, username)
+        self._invalidateUserIndex()
+        self.dirtySet.add("passwd")
 
         # add group
-        self.grpDict[username] = self._GrpEntry(username, "x", newUid, "")
-        self.perUserGroupList.append(username)
+        self._setItem(self.grpDict, username, self._GrpEntry(username, "x", newUid))
+        self._setItem(self.groupMemberDict, username, _OrderedSet())
+        self._listAppend(self.perUserGroupList, username)
+        self._setItem(self.gidDict, newUid, username)
+        self.dirtySet.add("group")
 
         # add shadow
-        self.shDict[username] = self._ShadowEntry(username, hosts.linux_context.encrypt(password), "", "", "", "", "", "", "")
-        self.shadowEntryList.append(username)
+        self._setItem(self.shDict, username, self._ShadowEntry(username, self._encryptPassword(username, password)))
+        self._listAppend(self.shadowEntryList, username)
+        self.dirtySet.add("shadow")
 
         # add subuid
-        m = self.subUidMin
-        for obj in self.subUidDict.values():
-            m = max(obj.start + obj.count, m)
-        self.subUidDict[username] = self._SubUidGidEntry(username, m, self.subUidCount)
-        self.subUidEntryList.append(username)
+        self._setItem(self.subUidDict, username, self._SubUidGidEntry(username, subUidStart, self.subUidCount))
+        self._listAppend(self.subUidEntryList, username)
+        self._invalidateSubIdIndex()
+        self.dirtySet.add("subuid")
 
         # add subgid
-        m = self.subGidMin
-        for obj in self.subGidDict.values():
-            m = max(obj.start + obj.count, m)
-        self.subGidDict[username] = self._SubUidGidEntry(username, m, self.subGidCount)
-        self.subGidEntryList.append(username)
+        self._setItem(self.subGidDict, username, self._SubUidGidEntry(username, subGidStart, self.subGidCount))
+        self._listAppend(self.subGidEntryList, username)
+        self._invalidateSubIdIndex()
+        self.dirtySet.add("subgid")
+
+        self._setAdd(self.touchedUserSet, username)
+        self._logOp("addNormalUser", username, _EncryptedPassword(self.shDict[username].sh_encpwd))
 
     def removeNormalUser(self, username):
         """do nothing if the user doesn't exists"""
         assert self.valid
+        self._detachState()
 
         if username in self.subGidEntryList:
-            self.subGidEntryList.remove(username)
-            del self.subGidDict[username]
+            self._listRemove(self.subGidEntryList, username)
+            self._releaseSubIds(self.subGidAllocator, self.subGidDict[username].start, self.subGidDict[username].count)
+            self._delItem(self.subGidDict, username)
+            self._invalidateSubIdIndex()
+            self.dirtySet.add("subgid")
 
         if username in self.subUidEntryList:
-            self.subUidEntryList.remove(username)
-            del self.subUidDict[username]
+            self._listRemove(self.subUidEntryList, username)
+            self._releaseSubIds(self.subUidAllocator, self.subUidDict[username].start, self.subUidDict[username].count)
+            self._delItem(self.subUidDict, username)
+            self._invalidateSubIdIndex()
+            self.dirtySet.add("subuid")
 
         if username in self.shadowEntryList:
-            self.shadowEntryList.remove(username)
-            del self.shDict[username]
+            self._listRemove(self.shadowEntryList, username)
+            self._cancelPassword(username)
+            self._delItem(self.shDict, username)
+            self.dirtySet.add("shadow")
 
-        if username in self.secondaryGroupsDict:
-            del self.secondaryGroupsDict[username]
-        for gname, entry in self.grpDict.items():
-            ulist = [x for x in entry.gr_mem.split(",") if x != ""]
-            if username in ulist:
-                ulist.remove(username)
-                self.grpDict[gname].gr_mem = ",".join(ulist)
+        for gname in list(self.userGroupDict.get(username, [])):
+            self._removeGroupMember(gname, username)
 
         if username in self.perUserGroupList:
-            self.perUserGroupList.remove(username)
-            del self.grpDict[username]
+            self._listRemove(self.perUserGroupList, username)
+            self._unindexGid(username)
+            if self.grpDict[username].gr_gid not in self.gidDict:
+                # the gid may be still used by another group
+                self._releaseId(self.gidAllocator, self.grpDict[username].gr_gid)
+            self._removeAllGroupMembers(username)
+            self._delItem(self.grpDict, username)
+            self.dirtySet.add("group")
 
         if username in self.normalUserList:
-            self.normalUserList.remove(username)
-            del self.pwdDict[username]
+            self._listRemove(self.normalUserList, username)
+            self._unindexUid(username)
+            if self.pwdDict[username].pw_uid not in self.uidDict:
+                # the uid may be still used by another user
+                self._releaseId(self.uidAllocator, self.pwdDict[username].pw_uid)
+            self._invalidateUserIndex()
+            self._delItem(self.pwdDict, username)
+            self.dirtySet.add("passwd")
+
+        self._setAdd(self.touchedUserSet, username)
+        self._logOp("removeNormalUser", username)
 
     def modifyNormalUser(self, username, op, *kargs):
         assert self.valid
+        self._detachState()
         assert username in self.normalUserList
 
         if op == MUSER_SET_PASSWORD:
             assert len(kargs) == 1
             password = kargs[0]
-            self.shDict[username].sh_encpwd = hosts.linux_context.encrypt(password)
+            self._cancelPassword(username)
+            self._setAttr(self.shDict[username], "sh_encpwd", self._encryptPassword(username, password))
+            self.dirtySet.add("shadow")
+            kargs = (_EncryptedPassword(self.shDict[username].sh_encpwd),)
         elif op == MUSER_SET_SHELL:
             assert False
         elif op == MUSER_JOIN_GROUP:
             assert len(kargs) == 1
             groupname = kargs[0]
-            assert groupname in self.systemGroupList + self.deviceGroupList + self.standAloneGroupList + self.softwareGroupList
-            if username not in self.secondaryGroupsDict:
-                self.secondaryGroupsDict[username] = []
-            if groupname not in self.secondaryGroupsDict[username]:
-                self.secondaryGroupsDict[username].append(groupname)
-            ulist = [x for x in self.grpDict[groupname].gr_mem.split(",") if x != ""]
-            if username not in ulist:
-                ulist.append(username)
-                self.grpDict[groupname].gr_mem = ",".join(ulist)
+            assert groupname in self.systemGroupList or groupname in self.deviceGroupList or groupname in self.standAloneGroupList or groupname in self.softwareGroupList
+            self._addGroupMember(groupname, username)
         elif op == MUSER_LEAVE_GROUP:
             assert len(kargs) == 1
             groupname = kargs[0]
-            if username in self.secondaryGroupsDict:
-                if groupname in self.secondaryGroupsDict[username]:
-                    self.secondaryGroupsDict[username].remove(groupname)
-            ulist = [x for x in self.grpDict[groupname].gr_mem.split(",") if x != ""]
-            if username in ulist:
-                ulist.remove(username)
-                self.grpDict[groupname].gr_mem = ",".join(ulist)
+            self._removeGroupMember(groupname, username)
         else:
             assert False
 
+        self._setAdd(self.touchedUserSet, username)
+        self._logOp("modifyNormalUser", username, op, *kargs)
+
     def addStandAloneGroup(self, groupname):
         assert self.valid
+        self._detachState()
         assert groupname not in self.grpDict
 
         # generate group id
-        newGid = 5000
-        while True:
-            if newGid >= 10000:
-                raise PgsAddGroupError("Can not find a valid group id")
-            if newGid in [v.grp_gid for v in self.grpDict.values()]:
-                newGid += 1
-                continue
-            break
+        newGid = self.gidAllocator.first()
+        if newGid is None:
+            raise PgsAddGroupError("Can not find a valid group id")
 
         # add group
-        self.grpDict[groupname] = self._GrpEntry(groupname, "x", newGid, "")
-        self.standAloneGroupList.append(groupname)
+        self._setItem(self.grpDict, groupname, self._GrpEntry(groupname, "x", newGid))
+        self._setItem(self.groupMemberDict, groupname, _OrderedSet())
+        self._listAppend(self.standAloneGroupList, groupname)
+        self._reserveId(self.gidAllocator, newGid)
+        self._setItem(self.gidDict, newGid, groupname)
+        self.dirtySet.add("group")
+
+        self._setAdd(self.touchedGroupSet, groupname)
+        self._logOp("addStandAloneGroup", groupname)
 
     def removeStandAloneGroup(self, groupname):
         assert self.valid
-
-        for glist in self.secondaryGroupsDict.values():
-            if groupname in glist:
-                glist.remove(groupname)
+        self._detachState()
 
         if groupname in self.standAloneGroupList:
-            self.standAloneGroupList.remove(groupname)
-            del self.grpDict[groupname]
+            self._listRemove(self.standAloneGroupList, groupname)
+            self._unindexGid(groupname)
+            if self.grpDict[groupname].gr_gid not in self.gidDict:
+                # the gid may be still used by another group
+                self._releaseId(self.gidAllocator, self.grpDict[groupname].gr_gid)
+            self._removeAllGroupMembers(groupname)
+            self._delItem(self.grpDict, groupname)
+            self.dirtySet.add("group")
+
+        self._setAdd(self.touchedGroupSet, groupname)
+        self._logOp("removeStandAloneGroup", groupname)
+
+    @contextlib.contextmanager
+    def batch(self):
+        """Do a group of modifications as one transaction:
+               with pgs.batch():
+                   pgs.addNormalUser(...)
+                   pgs.removeNormalUser(...)
+           The result is verified as a whole when the with block ends, then account files are written once
+           (in read-write mode). All the modifications are rolled back if any of them fails, or the verification
+           fails, or writing fails. Rolling back replays the undo log in reverse, so its cost is proportional to
+           the modifications done in the with block, not to the size of the account files.
+        """
+        assert self.valid
+        assert not self.inBatch
+
+        savedOpNum = len(self.opLog)
+        self.undoLog = []
+        self.undoOrderSet = set()
+        self.inBatch = True
+        try:
+            self._undoable(setattr, self, "dirtySet", set(self.dirtySet))
+            yield self
+            self._waitPasswords()
+            self._raiseFirst(self._checkStage1Touched())
+            if not self.readOnly:
+                self._commit()
+        except BaseException:
+            for func, args in reversed(self.undoLog):
+                func(*args)
+            if self.filesUnknown:
+                # the rolled back dirtySet and baseIdentity don't describe the account files any more
+                self._markFilesUnknown()
+            self._invalidateQueryIndex()
+            del self.opLog[savedOpNum:]
+            raise
+        finally:
+            self.undoLog = None
+            self.undoOrderSet = None
+            self.inBatch = False
+
+        if not self.readOnly:
+            self._exportCommitted()
+
+    def exportCdb(self):
+        """Export passwd and group to /etc/passwd.cdb and /etc/group.cdb, which are constant databases in the
+           format of cdb by D. J. Bernstein (https://cr.yp.to/cdb/cdb.txt), so that other programs can look up
+           users and groups by hash instead of parsing the flat files. Keys and values are UTF-8 strings:
+             passwd.cdb:  ".<username>"  -> line of /etc/passwd
+                          "=<uid>"       -> line of /etc/passwd, the first one if the uid is not unique
+             group.cdb:   ".<groupname>" -> line of /etc/group
+                          "=<gid>"       -> line of /etc/group, the first one if the gid is not unique
+                          ":<username>"  -> comma separated names of the groups which has the user as member, sorted
+                          "#system", "#device", "#per-user", "#stand-alone", "#software", "#deprecated"
+                                         -> comma separated group names of each category
+             passwd.cdb:  "#system", "#normal", "#software", "#deprecated"
+                                         -> comma separated user names of each category
+             both:        "#version"     -> format version, currently "3"
+                          "#source"      -> "<inode>:<mtime_ns>:<size>" of /etc/login.defs, /etc/passwd (and /etc/group
+                                            for group.cdb), comma separated. The cdb file is out of date if they differ
+                                            from the current files.
+           A cdb file is not re-generated if it is not out of date.
+           In writable mode, this is done by committing when cdbExport is specified.
+           See also PasswdGroupShadow.openMapped()."""
+
+        assert self.valid
+        assert self.readOnly
+        assert not self.modified            # the exported files must reflect the account files
+        self._exportCdb()
 
     def close(self):
         assert self.valid
+        assert not self.inBatch
+
+        try:
+            if not self.readOnly:
+                self._commit()
+                if not self.optimistic:
+                    self._unlockPwd()
+        finally:
+            if self.hashExecutor is not None:
+                self.hashExecutor.shutdown(cancel_futures=True)
+                self.hashExecutor = None
+        self.valid = False
 
         if not self.readOnly:
-            self._fixate()
+            self._exportCommitted()
+
+    def _statFiles(self):
+        """returns (inode, mtime, size) of all the files which are parsed, None for non-existent file"""
+        return _statFileList([self.loginDefFile, self.passwdFile, self.groupFile, self.shadowFile, self.subuidFile, self.subgidFile])
+
+    def _parseFiles(self, lazy):
+        self._parsePasswd()
+        self._parseGroup(self.normalUserList)
+        if lazy:
+            for table in self._lazyTableAttrDict:
+                self._unloadTable(table)
+        else:
+            self._parseShadow()
+            self._parseSubUid()
+            self._parseSubGid()
+
+    def _parseSnapshot(self):
+        # same as seqlock, files are replaced by rename() when committing, so an unchanged identity means unchanged content
+        interval = self._lockIntervalMin
+        for i in range(0, self._snapshotRetries + 1):
+            fileIdentity = self._statFiles()
+            try:
+                self._parseLoginDef()
+                self._parseFiles(False)
+                self._verifyStage1()
+                error = None
+            except PgsFormatError as e:
+                # a mixture of old and new files may be inconsistent
+                error = e
+            if self._statFiles() == fileIdentity:
+                if error is not None:
+                    raise error
+                self.baseIdentity = fileIdentity
+                return
+            self.snapshotRetries += 1
+            time.sleep(interval)
+            interval = min(interval * 2, self._lockIntervalMax)
+        raise PgsLockError("Failed to get a consistent snapshot, account files keep changing")
+
+    def _unloadTable(self, table):
+        for k in self._lazyTableAttrDict[table]:
+            self.__dict__.pop(k, None)
+        self.lazyTableSet.add(table)
+
+    def _loadTable(self, table):
+        try:
+            if table == "shadow":
+                self._parseShadow()
+            elif table == "subuid":
+                self._parseSubUid()
+            elif table == "subgid":
+                self._parseSubGid()
+            else:
+                assert False
+        except BaseException:
+            # drop what is partially parsed, so that parsing is tried again next time
+            self._unloadTable(table)
+            raise
+        self.lazyTableSet.remove(table)
+
+        # the table stays loaded if verification fails, so that the problem is reported by the following verify() and check() too
+        if table == "shadow":
+            self._verifyStage1Shadow()
+
+    def _detachState(self):
+        """called first by every modification: copy the state shared with the cache, mark the state modified, and load the tables not parsed yet"""
+        if self.sharedState:
+            self._restoreState(self._saveState())
+            self.sharedState = False
+        if not self.modified:
+            self._setAttr(self, "modified", True)
+
+        # loading a table verifies it against the other tables, which would fail on a half done modification
+        for table in list(self.lazyTableSet):
+            self._loadTable(table)
+
+    def _saveState(self):
+        # pending password encryptions are shared with the saved state, futures can't be copied
+        memo = dict()
+        for uname in self.pendingPwdSet:
+            f = self.shDict[uname].sh_encpwd
+            memo[id(f)] = f
+        return copy.deepcopy({k: getattr(self, k) for k in self._stateAttrList}, memo)
+
+    def _restoreState(self, savedState):
+        for k, v in savedState.items():
+            setattr(self, k, v)
+        self._invalidateQueryIndex()
+
+    def _commit(self):
+        if not self.optimistic:
+            self._commitFiles()
+            return
+
+        self._lockPwd()
+        try:
+            self._rebase()
+            self._commitFiles()
+            self.opLog = []
+        finally:
+            self._unlockPwd()
+
+    def _rebase(self):
+        """parse account files again and replay the operation log if they were changed by other processes, lock must be held.
+           The replay is done on a new instance, whose state is taken only when the replay succeeds."""
+
+        fileIdentity = self._statFiles()
+        if fileIdentity == self.baseIdentity:
+            return
+
+        try:
+            other = PasswdGroupShadow(self.dirPrefix, readOnly=False, optimistic=True)
+            for name, args in self.opLog:
+                getattr(other, name)(*args)
+            other._waitPasswords()
+            other._verifyStage1()
+        except Exception as e:
+            raise PgsConflictError("Account files were changed by other process, and the modifications can not be applied: %s" % (e)) from e
+
+        # the previous state is taken back by rolling back batch(), together with the identity it is based on
+        attrList = self._loginDefAttrList + self._stateAttrList + ["baseIdentity"]
+        self._undoable(self._restoreState, {k: getattr(self, k) for k in attrList})
+        self._restoreState({k: getattr(other, k) for k in attrList})
+        self.opLog = other.opLog
+
+    def _commitFiles(self):
+        self._waitPasswords()
+        self._fixate()
+        try:
             self._writePasswd()
             self._writeGroup()
             self._writeShadow()
             self._writeGroupShadow()
             self._writeSubUid()
             self._writeSubGid()
-            self._unlockPwd()
-        self.valid = False
-
-    def _parseLoginDef(self):
-        if not os.path.exists(self.loginDefFile):
-            raise PgsFormatError("%s is missing" % (self.loginDefFile))
-        buf = pathlib.Path(self.loginDefFile).read_text()
-
-        m = re.search(r'\s*UID_MIN\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.uidMin = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, UID_MIN is missing." % (self.loginDefFile))
-
-        m = re.search(r'\s*UID_MAX\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.uidMax = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, UID_MAX is missing." % (self.loginDefFile))
-
-        m = re.search(r'\s*GID_MIN\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.gidMin = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, GID_MIN is missing." % (self.loginDefFile))
-
-        m = re.search(r'\s*GID_MAX\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.gidMax = int(m.group(1))
+        except BaseException:
+            self._discardFiles()
+            raise
+        self._replaceFiles()
+        self.dirtySet.clear()
+        self.filesUnknown = False
+        self.baseIdentity = self._statFiles()
+
+    def _exportCommitted(self):
+        """called after a commit is done and out of the rollback of batch() and the unlocking of close()"""
+        if not self.cdbExport:
+            return
+        try:
+            self._exportCdb()
+        except Exception as e:
+            raise PgsCdbExportError("Account files are committed, but exporting cdb files failed: %s" % (e)) from e
+
+    def _encryptPassword(self, username, password):
+        """Returns encrypted password, or a future of it if encryption is done by worker processes.
+           ENCRYPT_METHOD, SHA_CRYPT_MIN_ROUNDS and SHA_CRYPT_MAX_ROUNDS in login.defs are honored."""
+
+        if isinstance(password, _EncryptedPassword):
+            # replayed operation
+            if isinstance(password.value, concurrent.futures.Future):
+                self._setAdd(self.pendingPwdSet, username)
+            return password.value
+
+        scheme = self._encryptMethodDict.get(self.loginDefs.get("ENCRYPT_METHOD"))
+        rounds = None
+        if scheme in ["sha256_crypt", "sha512_crypt"]:
+            minRounds = self.loginDefs.get("SHA_CRYPT_MIN_ROUNDS")
+            maxRounds = self.loginDefs.get("SHA_CRYPT_MAX_ROUNDS")
+            if isinstance(minRounds, int) and isinstance(maxRounds, int) and minRounds <= maxRounds:
+                rounds = random.randint(minRounds, maxRounds)
+            elif isinstance(minRounds, int):
+                rounds = minRounds
+            elif isinstance(maxRounds, int):
+                rounds = maxRounds
+
+        if self.hashWorkers == 0:
+            return _encryptPassword(password, scheme, rounds)
+        if self.hashExecutor is None:
+            self.hashExecutor = concurrent.futures.ProcessPoolExecutor(max_workers=self.hashWorkers)
+        self._setAdd(self.pendingPwdSet, username)
+        return self.hashExecutor.submit(_encryptPassword, password, scheme, rounds)
+
+    def _cancelPassword(self, username):
+        if username in self.pendingPwdSet:
+            self._setRemove(self.pendingPwdSet, username)
+            if self.undoLog is None:
+                # in batch(), the encryption is left to finish, rolling back may need its result again
+                self.shDict[username].sh_encpwd.cancel()
+
+    def _logOp(self, name, *args):
+        if self.optimistic:
+            self.opLog.append((name, args))
+
+    def _undoable(self, func, *args):
+        """record func(*args), which undoes a modification, when in batch()"""
+        if self.undoLog is not None:
+            self.undoLog.append((func, args))
+
+    # the modification helpers below record their undo in batch(), the parsed state is modified only by them,
+    # except dirtySet which is small and saved as a whole by batch()
+
+    def _setAttr(self, obj, name, value):
+        self._undoable(setattr, obj, name, getattr(obj, name))
+        setattr(obj, name, value)
+
+    def _setItem(self, theDict, key, value):
+        if key in theDict:
+            self._undoable(theDict.__setitem__, key, theDict[key])
         else:
-            raise PgsFormatError("Invalid format of %s, GID_MAX is missing." % (self.loginDefFile))
+            self._undoable(theDict.__delitem__, key)
+        theDict[key] = value
+
+    def _delItem(self, theDict, key):
+        self._undoable(theDict.__setitem__, key, theDict[key])
+        del theDict[key]
+
+    def _setAdd(self, theSet, x):
+        if x not in theSet:
+            self._undoable(theSet.discard, x)
+            theSet.add(x)
+
+    def _setRemove(self, theSet, x):
+        self._undoable(theSet.add, x)
+        theSet.remove(x)
+
+    def _setDiscard(self, theSet, x):
+        if x in theSet:
+            self._setRemove(theSet, x)
+
+    def _listAppend(self, orderedSet, x):
+        if x not in orderedSet:
+            self._undoable(orderedSet.discard, x)
+            orderedSet.append(x)
+
+    def _listRemove(self, orderedSet, x):
+        # a removed element can't be put back to its position in O(1), so the order before the first removal or sorting is saved
+        self._saveOrder(orderedSet)
+        orderedSet.remove(x)
+
+    def _listSort(self, orderedSet, key):
+        self._saveOrder(orderedSet)
+        orderedSet.sort(key=key)
+
+    def _saveOrder(self, orderedSet):
+        if self.undoLog is not None and id(orderedSet) not in self.undoOrderSet:
+            # the saved order is restored after undoing all the later modifications, so it needs to be saved only once
+            self.undoOrderSet.add(id(orderedSet))
+            self._undoable(orderedSet.setOrder, orderedSet.getOrder())
+
+    def _reserveId(self, allocator, id):
+        if allocator.isFree(id):
+            self._undoable(allocator.release, id)
+            allocator.reserve(id)
+
+    def _releaseId(self, allocator, id):
+        if allocator.idMin <= id < allocator.idMax and not allocator.isFree(id):
+            self._undoable(allocator.reserve, id)
+            allocator.release(id)
+
+    def _allocateSubIds(self, allocator):
+        start = allocator.allocate()
+        if start is not None:
+            self._undoable(allocator.release, start, allocator.subIdCount)
+        return start
+
+    def _releaseSubIds(self, allocator, start, count):
+        if allocator.isValid(start, count) and not allocator.isFree(start, count):
+            self._undoable(allocator.reserve, start, count)
+            allocator.release(start, count)
+
+    def _waitPasswords(self):
+        for uname in list(self.pendingPwdSet):
+            e = self.shDict[uname]
+            self._setAttr(e, "sh_encpwd", e.sh_encpwd.result())
+            self._setRemove(self.pendingPwdSet, uname)
+
+    def _invalidateQueryIndex(self):
+        self._invalidateUserIndex()
+        self._invalidateSubIdIndex()
+        self.secondaryGroupsCache = dict()
+
+    def _invalidateSubIdIndex(self):
+        """called when subuid or subgid entries are added, removed or changed"""
+        self.subUidIndex = None
+        self.subGidIndex = None
+
+    def _getSubUidIndex(self):
+        if self.subUidIndex is None:
+            self.subUidIndex = self._buildSubIdIndex(self.subUidDict)
+        return self.subUidIndex
+
+    def _getSubGidIndex(self):
+        if self.subGidIndex is None:
+            self.subGidIndex = self._buildSubIdIndex(self.subGidDict)
+        return self.subGidIndex
+
+    @staticmethod
+    def _buildSubIdIndex(subIdDict):
+        entryList = sorted(subIdDict.values(), key=lambda x: x.start)
+        startList = [e.start for e in entryList]
+        endList = [e.start + e.count for e in entryList]
+        nameList = [e.name for e in entryList]
+        maxEndList = list(itertools.accumulate(endList, max))
+        return (startList, endList, nameList, maxEndList)
+
+    @staticmethod
+    def _findSubIdOverlaps(index, start, count, firstOnly):
+        """returns names of ranges overlapping [start, start + count), the one with greater start comes first"""
+        startList, endList, nameList, maxEndList = index
+        ret = []
+        # scan backward from the last range starting before the end, until no earlier range can reach start,
+        # which stops at once if ranges don't overlap each other
+        i = bisect.bisect_left(startList, start + count) - 1
+        while i >= 0 and maxEndList[i] > start:
+            if endList[i] > start:
+                ret.append(nameList[i])
+                if firstOnly:
+                    break
+            i -= 1
+        return ret
 
-        m = re.search(r'\s*SUB_UID_MIN\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.subUidMin = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_UID_MIN is missing, shadow version too low?" % (self.loginDefFile))
+    def _invalidateUserIndex(self):
+        """called when users are added or removed, or their shell or home directory is changed"""
+        self.shellIndex = None
+        self.homeIndex = None
+
+    def _getShellIndex(self):
+        if self.shellIndex is None:
+            self.shellIndex = dict()
+            for uname, e in self.pwdDict.items():
+                self.shellIndex.setdefault(e.pw_shell, set()).add(uname)
+        return self.shellIndex
+
+    def _queryHomePrefix(self, prefix):
+        if self.homeIndex is None:
+            self.homeIndex = sorted((e.pw_dir, uname) for uname, e in self.pwdDict.items())
+        ret = set()
+        i = bisect.bisect_left(self.homeIndex, (prefix,))
+        while i < len(self.homeIndex) and self.homeIndex[i][0].startswith(prefix):
+            ret.add(self.homeIndex[i][1])
+            i += 1
+        return ret
 
-        m = re.search(r'\s*SUB_UID_MAX\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.subUidMax = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_UID_MAX is missing, shadow version too low?" % (self.loginDefFile))
+    @staticmethod
+    def _intersect(candidateList, allDict):
+        # start from the smallest candidate, so that the cost is decided by it
+        if len(candidateList) == 0:
+            return set(allDict)
+        candidateList.sort(key=len)
+        ret = set(candidateList[0])
+        for c in candidateList[1:]:
+            ret = {x for x in ret if x in c}
+        return ret
 
-        m = re.search(r'\s*SUB_UID_COUNT\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.subUidCount = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_UID_COUNT is missing, shadow version too low?" % (self.loginDefFile))
+    def _unindexUid(self, username):
+        """remove user from uidDict before it is removed from pwdDict"""
+        uid = self.pwdDict[username].pw_uid
+        if self.uidDict.get(uid) != username:
+            return
+        self._delItem(self.uidDict, uid)
+        if uid in self.dupUidSet:
+            # rare, so a linear search is fine
+            for uname, e in self.pwdDict.items():
+                if e.pw_uid == uid and uname != username:
+                    self._setItem(self.uidDict, uid, uname)
+                    break
+
+    def _unindexGid(self, groupname):
+        """remove group from gidDict before it is removed from grpDict"""
+        gid = self.grpDict[groupname].gr_gid
+        if self.gidDict.get(gid) != groupname:
+            return
+        self._delItem(self.gidDict, gid)
+        if gid in self.dupGidSet:
+            # rare, so a linear search is fine
+            for gname, e in self.grpDict.items():
+                if e.gr_gid == gid and gname != groupname:
+                    self._setItem(self.gidDict, gid, gname)
+                    break
+
+    def _addGroupMember(self, groupname, username):
+        self.secondaryGroupsCache.pop(username, None)
+        self._listAppend(self.groupMemberDict[groupname], username)
+        if username not in self.userGroupDict:
+            self._setItem(self.userGroupDict, username, set())
+        self._setAdd(self.userGroupDict[username], groupname)
+        self.dirtySet.add("group")
+
+    def _removeGroupMember(self, groupname, username):
+        """do nothing if the user is not a member of the group"""
+        if username not in self.groupMemberDict[groupname]:
+            return
+        self.secondaryGroupsCache.pop(username, None)
+        self._listRemove(self.groupMemberDict[groupname], username)
+        self._setRemove(self.userGroupDict[username], groupname)
+        self.dirtySet.add("group")
+        if len(self.userGroupDict[username]) == 0:
+            self._delItem(self.userGroupDict, username)
+
+    def _removeAllGroupMembers(self, groupname):
+        for uname in list(self.groupMemberDict[groupname]):
+            self._removeGroupMember(groupname, uname)
+        self._delItem(self.groupMemberDict, groupname)
+        self._setDiscard(self.groupMemberFlawSet, groupname)
 
-        m = re.search(r'\s*SUB_GID_MIN\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.subGidMin = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_GID_MIN is missing, shadow version too low?" % (self.loginDefFile))
+    def _parseLoginDef(self):
+        if not os.path.exists(self.loginDefFile):
+            raise PgsFormatError("%s is missing" % (self.loginDefFile))
+        self.loginDefs = getLoginDefs(self.loginDefFile)
 
-        m = re.search(r'\s*SUB_GID_MAX\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.subGidMax = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_GID_MAX is missing, shadow version too low?" % (self.loginDefFile))
+        for key, attr in [("UID_MIN", "uidMin"), ("UID_MAX", "uidMax"), ("GID_MIN", "gidMin"), ("GID_MAX", "gidMax")]:
+            if not isinstance(self.loginDefs.get(key), int):
+                raise PgsFormatError("Invalid format of %s, %s is missing." % (self.loginDefFile, key))
+            setattr(self, attr, self.loginDefs[key])
 
-        m = re.search(r'\s*SUB_GID_COUNT\s+([0-9]+)\s*$', buf, re.M)
-        if m is not None:
-            self.subGidCount = int(m.group(1))
-        else:
-            raise PgsFormatError("Invalid format of %s, SUB_GID_COUNT is missing, shadow version too low?" % (self.loginDefFile))
+        for key, attr in [("SUB_UID_MIN", "subUidMin"), ("SUB_UID_MAX", "subUidMax"), ("SUB_UID_COUNT", "subUidCount"),
+                          ("SUB_GID_MIN", "subGidMin"), ("SUB_GID_MAX", "subGidMax"), ("SUB_GID_COUNT", "subGidCount")]:
+            if not isinstance(self.loginDefs.get(key), int):
+                raise PgsFormatError("Invalid format of %s, %s is missing, shadow version too low?" % (self.loginDefFile, key))
+            setattr(self, attr, self.loginDefs[key])
 
         if self.uidMax < self.uidMin:
             raise PgsFormatError("Invalid format of %s, UID_MAX is lesser than UID_MIN." % (self.loginDefFile))
@@ -515,38 +1603,84 @@ class PasswdGroupShadow:
         if (self.subGidMax - self.subGidMin) % self.subGidCount != 0:
             raise PgsFormatError("Invalid format of %s, SUB_GID_MIN, SUB_GID_MAX and SUB_GID_COUNT is not aligned." % (self.loginDefFile))
 
-    def _parsePasswd(self):
-        lineList = pathlib.Path(self.passwdFile).read_text().split("\n")
-        for line in lineList:
-            if line == "" or line.startswith("#"):
-                continue
+    def _readRecords(self, filename, fileDesc, fieldNum, intFieldList, internFieldList):
+        """Yield the field list of every entry in an account file.
+           The file is read line by line through a buffered reader, so only one line is in memory at a time.
+           Fields in intFieldList are converted to int, fields in internFieldList are interned because they
+           mostly share a few values, such as "x", "/sbin/nologin" and "/bin/bash", or are used elsewhere,
+           such as usernames in group member fields."""
+
+        with open(filename) as f:
+            lineNo = 0
+            for line in f:
+                lineNo += 1
+                if line.endswith("\n"):
+                    line = line[:-1]
+                if line == "" or line.startswith("#"):
+                    continue
 
-            t = line.split(":")
-            if len(t) != 7:
-                raise PgsFormatError("Invalid format of passwd file")
+                t = line.split(":")
+                if len(t) != fieldNum:
+                    raise PgsFormatError("Invalid format of %s file, line %d" % (fileDesc, lineNo))
+                try:
+                    for i in intFieldList:
+                        t[i] = int(t[i])
+                except ValueError:
+                    raise PgsFormatError("Invalid format of %s file, line %d" % (fileDesc, lineNo))
+                for i in internFieldList:
+                    t[i] = sys.intern(t[i])
+                yield t
+
+    def _parsePasswd(self):
+        self._invalidateQueryIndex()
+        self.systemUserList = _OrderedSet()
+        self.normalUserList = _OrderedSet()
+        self.softwareUserList = _OrderedSet()
+        self.deprecatedUserList = _OrderedSet()
+        self.pwdDict = dict()                   # key: username; value: _PwdEntry
+        self.uidAllocator = _IdAllocator(self.uidMin, self.uidMax)          # free user ids in [uidMin, uidMax)
 
-            self.pwdDict[t[0]] = self._PwdEntry(t)
+        for t in self._readRecords(self.passwdFile, "passwd", 7, [2, 3], [0, 1, 4, 5, 6]):
+            self.pwdDict[t[0]] = self._PwdEntry(*t)
+            self.uidAllocator.reserve(self.pwdDict[t[0]].pw_uid)
 
             if t[0] in self._stdSystemUserList:
                 self.systemUserList.append(t[0])
-            elif self.uidMin <= int(t[2]) < self.uidMax:
+            elif self.uidMin <= t[2] < self.uidMax:
                 self.normalUserList.append(t[0])
             elif t[0] in self._stdDeprecatedUserList:
                 self.deprecatedUserList.append(t[0])
             else:
                 self.softwareUserList.append(t[0])
 
-    def _parseGroup(self, normalUserList):
-        lineList = pathlib.Path(self.groupFile).read_text().split("\n")
-        for line in lineList:
-            if line == "" or line.startswith("#"):
-                continue
-
-            t = line.split(":")
-            if len(t) != 4:
-                raise PgsFormatError("Invalid format of group file")
+        self.uidDict = dict()                   # key: uid; value: username, the first one in passwd if the uid is not unique
+        self.dupUidSet = set()                  # uids shared by more than one user
+        for uname, e in self.pwdDict.items():
+            if e.pw_uid in self.uidDict:
+                self.dupUidSet.add(e.pw_uid)
+            else:
+                self.uidDict[e.pw_uid] = uname
 
-            self.grpDict[t[0]] = self._GrpEntry(t)
+    def _parseGroup(self, normalUserList):
+        self._invalidateQueryIndex()
+        self.systemGroupList = _OrderedSet()
+        self.deviceGroupList = _OrderedSet()
+        self.perUserGroupList = _OrderedSet()
+        self.standAloneGroupList = _OrderedSet()
+        self.softwareGroupList = _OrderedSet()
+        self.deprecatedGroupList = _OrderedSet()
+        self.grpDict = dict()                   # key: groupname; value: _GrpEntry
+        self.gidAllocator = _IdAllocator(self.gidMin, self.gidMax)          # free group ids in [gidMin, gidMax)
+        self.groupMemberDict = dict()           # key: groupname; value: _OrderedSet of member usernames
+        self.userGroupDict = dict()             # key: username; value: set of groupnames which has the user as member
+        self.groupMemberFlawSet = set()         # groupnames whose member field is not in standard form
+
+        for t in self._readRecords(self.groupFile, "group", 4, [2], [1]):
+            if t[0] in self.groupMemberDict:
+                # duplicate entry, the last one wins
+                self._removeAllGroupMembers(t[0])
+            self.grpDict[t[0]] = self._GrpEntry(t[0], t[1], t[2])
+            self.gidAllocator.reserve(self.grpDict[t[0]].gr_gid)
 
             if t[0] in self._stdSystemGroupList:
                 self.systemGroupList.append(t[0])
@@ -556,154 +1690,240 @@ class PasswdGroupShadow:
                 self.deviceGroupList.append(t[0])
             elif t[0] in self._stdDeprecatedGroupList:
                 self.deprecatedGroupList.append(t[0])
-            elif self.gidMin <= int(t[2]) < self.gidMax:
+            elif self.gidMin <= t[2] < self.gidMax:
                 self.standAloneGroupList.append(t[0])
             else:
                 self.softwareGroupList.append(t[0])
 
+            self.groupMemberDict[t[0]] = _OrderedSet()
             for u in t[3].split(","):
                 if u == "":
                     continue
-                if u not in self.secondaryGroupsDict:
-                    self.secondaryGroupsDict[u] = []
-                self.secondaryGroupsDict[u].append(t[0])
+                self._addGroupMember(t[0], sys.intern(u))
+            if t[3] != ",".join(self.groupMemberDict[t[0]]):
+                self.groupMemberFlawSet.add(t[0])
+
+        self.gidDict = dict()                   # key: gid; value: groupname, the first one in group if the gid is not unique
+        self.dupGidSet = set()                  # gids shared by more than one group
+        for gname, e in self.grpDict.items():
+            if e.gr_gid in self.gidDict:
+                self.dupGidSet.add(e.gr_gid)
+            else:
+                self.gidDict[e.gr_gid] = gname
 
     def _parseShadow(self):
+        self.shadowEntryList = _OrderedSet()
+        self.shDict = dict()                    # key: username; value: _ShadowEntry
+
         if not os.path.exists(self.shadowFile):
             return
 
-        for line in pathlib.Path(self.shadowFile).read_text().split("\n"):
-            if line == "" or line.startswith("#"):
-                continue
-
-            t = line.split(":")
-            if len(t) != 9:
-                raise PgsFormatError("Invalid format of shadow file")
-
-            self.shDict[t[0]] = self._ShadowEntry(t)
+        for t in self._readRecords(self.shadowFile, "shadow", 9, [], []):
+            if len(t[1]) <= 4:
+                # locked or empty password, such as "*" and "!"
+                t[1] = sys.intern(t[1])
+            self.shDict[t[0]] = self._ShadowEntry(t[0], t[1])
             self.shadowEntryList.append(t[0])
 
     def _parseSubUid(self):
+        self.subUidIndex = None
+        self.subUidEntryList = _OrderedSet()
+        self.subUidDict = dict()                # key: username; value: _SubUidGidEntry
+        self.subUidAllocator = _SubIdAllocator(self.subUidMin, self.subUidMax, self.subUidCount)      # free subordinate user id slots
+
         if not os.path.exists(self.subuidFile):
             return
 
-        for line in pathlib.Path(self.subuidFile).read_text().split("\n"):
-            if line == "" or line.startswith("#"):
-                continue
-
-            t = line.split(":")
-            if len(t) != 3:
-                raise PgsFormatError("Invalid format of subuid file")
-
-            self.subUidDict[t[0]] = self._SubUidGidEntry(t[0], int(t[1]), int(t[2]))
+        for t in self._readRecords(self.subuidFile, "subuid", 3, [1, 2], []):
+            self.subUidDict[t[0]] = self._SubUidGidEntry(t[0], t[1], t[2])
             self.subUidEntryList.append(t[0])
+            self.subUidAllocator.reserve(self.subUidDict[t[0]].start, self.subUidDict[t[0]].count)
 
     def _parseSubGid(self):
+        self.subGidIndex = None
+        self.subGidEntryList = _OrderedSet()
+        self.subGidDict = dict()                # key: username; value: _SubUidGidEntry
+        self.subGidAllocator = _SubIdAllocator(self.subGidMin, self.subGidMax, self.subGidCount)      # free subordinate group id slots
+
         if not os.path.exists(self.subgidFile):
             return
 
-        for line in pathlib.Path(self.subgidFile).read_text().split("\n"):
-            if line == "" or line.startswith("#"):
-                continue
-
-            t = line.split(":")
-            if len(t) != 3:
-                raise PgsFormatError("Invalid format of subgid file")
-
-            self.subGidDict[t[0]] = self._SubUidGidEntry(t[0], int(t[1]), int(t[2]))
+        for t in self._readRecords(self.subgidFile, "subgid", 3, [1, 2], []):
+            self.subGidDict[t[0]] = self._SubUidGidEntry(t[0], t[1], t[2])
             self.subGidEntryList.append(t[0])
+            self.subGidAllocator.reserve(self.subGidDict[t[0]].start, self.subGidDict[t[0]].count)
 
     def _writePasswd(self):
-        shutil.copy2(self.passwdFile, self.passwdFile + "-")
-        with open(self.passwdFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for uname in self.systemUserList:
-                f.write(self._pwd2str(self.pwdDict[uname]))
-                f.write("\n")
-            f.write("\n")
-            for uname in self.normalUserList:
-                f.write(self._pwd2str(self.pwdDict[uname]))
-                f.write("\n")
-            f.write("\n")
-            for uname in self.softwareUserList:
-                f.write(self._pwd2str(self.pwdDict[uname]))
-                f.write("\n")
-            f.write("\n")
-            for uname in self.deprecatedUserList:
-                f.write(self._pwd2str(self.pwdDict[uname]))
-                f.write("\n")
+        if "passwd" not in self.dirtySet:
+            return
+        buf = [self.manageFlag + "\n"]
+        buf.append("\n")
+        for uname in self.systemUserList:
+            buf.append(self._pwd2str(self.pwdDict[uname]) + "\n")
+        buf.append("\n")
+        for uname in self.normalUserList:
+            buf.append(self._pwd2str(self.pwdDict[uname]) + "\n")
+        buf.append("\n")
+        for uname in self.softwareUserList:
+            buf.append(self._pwd2str(self.pwdDict[uname]) + "\n")
+        buf.append("\n")
+        for uname in self.deprecatedUserList:
+            buf.append(self._pwd2str(self.pwdDict[uname]) + "\n")
+        self._writeFile(self.passwdFile, "".join(buf), 0o644)
 
     def _writeGroup(self):
-        shutil.copy2(self.groupFile, self.groupFile + "-")
-        with open(self.groupFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for gname in self.systemGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.perUserGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.standAloneGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.deviceGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.softwareGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
-            f.write("\n")
-            for gname in self.deprecatedGroupList:
-                f.write(self._grp2str(self.grpDict[gname]))
-                f.write("\n")
+        if "group" not in self.dirtySet:
+            return
+        buf = [self.manageFlag + "\n"]
+        buf.append("\n")
+        for gname in self.systemGroupList:
+            buf.append(self._grp2str(self.grpDict[gname]) + "\n")
+        buf.append("\n")
+        for gname in self.perUserGroupList:
+            buf.append(self._grp2str(self.grpDict[gname]) + "\n")
+        buf.append("\n")
+        for gname in self.standAloneGroupList:
+            buf.append(self._grp2str(self.grpDict[gname]) + "\n")
+        buf.append("\n")
+        for gname in self.deviceGroupList:
+            buf.append(self._grp2str(self.grpDict[gname]) + "\n")
+        buf.append("\n")
+        for gname in self.softwareGroupList:
+            buf.append(self._grp2str(self.grpDict[gname]) + "\n")
+        buf.append("\n")
+        for gname in self.deprecatedGroupList:
+            buf.append(self._grp2str(self.grpDict[gname]) + "\n")
+        self._writeFile(self.groupFile, "".join(buf), 0o644)
 
     def _writeShadow(self):
-        if os.path.exists(self.shadowFile):
-            shutil.copy2(self.shadowFile, self.shadowFile + "-")
-        with open(self.shadowFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for sname in self.shadowEntryList:
-                f.write(self._sh2str(self.shDict[sname]))
-                f.write("\n")
+        if "shadow" not in self.dirtySet:
+            return
+        buf = [self.manageFlag + "\n"]
+        buf.append("\n")
+        for sname in self.shadowEntryList:
+            buf.append(self._sh2str(self.shDict[sname]) + "\n")
+        self._writeFile(self.shadowFile, "".join(buf), 0o600)
 
     def _writeGroupShadow(self):
-        if os.path.exists(self.gshadowFile):
-            shutil.copy2(self.gshadowFile, self.gshadowFile + "-")
-        with open(self.gshadowFile, "w") as f:
-            f.truncate()
+        if "gshadow" not in self.dirtySet:
+            return
+        self._writeFile(self.gshadowFile, "", 0o600)
 
     def _writeSubUid(self):
-        if os.path.exists(self.subuidFile):
-            shutil.copy2(self.subuidFile, self.subuidFile + "-")
-        with open(self.subuidFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for name in self.subUidEntryList:
-                f.write(self._subuidgid2str(self.subUidDict[name]))
-                f.write("\n")
+        if "subuid" not in self.dirtySet:
+            return
+        buf = [self.manageFlag + "\n"]
+        buf.append("\n")
+        for name in self.subUidEntryList:
+            buf.append(self._subuidgid2str(self.subUidDict[name]) + "\n")
+        self._writeFile(self.subuidFile, "".join(buf), 0o644)
 
     def _writeSubGid(self):
-        if os.path.exists(self.subgidFile):
-            shutil.copy2(self.subgidFile, self.subgidFile + "-")
-        with open(self.subgidFile, "w") as f:
-            f.write(self.manageFlag + "\n")
-            f.write("\n")
-            for name in self.subGidEntryList:
-                f.write(self._subuidgid2str(self.subGidDict[name]))
-                f.write("\n")
+        if "subgid" not in self.dirtySet:
+            return
+        buf = [self.manageFlag + "\n"]
+        buf.append("\n")
+        for name in self.subGidEntryList:
+            buf.append(self._subuidgid2str(self.subGidDict[name]) + "\n")
+        self._writeFile(self.subgidFile, "".join(buf), 0o644)
+
+    def _writeFile(self, filename, buf, defaultMode):
+        """Write buf into a temporary file in the same directory, it replaces filename in _replaceFiles().
+           Permission and ownership of the original file are kept.
+           Do nothing if the content of filename is already buf."""
+
+        try:
+            with open(filename) as f:
+                if f.read() == buf:
+                    return
+        except FileNotFoundError:
+            pass
+
+        fd, tmpFile = tempfile.mkstemp(prefix=".%s." % (os.path.basename(filename)), dir=os.path.dirname(filename))
+        try:
+            try:
+                st = os.stat(filename)
+                os.fchmod(fd, stat.S_IMODE(st.st_mode))
+                tst = os.fstat(fd)
+                if (st.st_uid, st.st_gid) != (tst.st_uid, tst.st_gid):
+                    os.fchown(fd, st.st_uid, st.st_gid)
+            except FileNotFoundError:
+                os.fchmod(fd, defaultMode)
+            with os.fdopen(fd, "w") as f:
+                fd = None
+                f.write(buf)
+                if self.fsyncPolicy != FSYNC_NONE:
+                    f.flush()
+                    os.fsync(f.fileno())
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            os.unlink(tmpFile)
+            raise
+        self.pendingWriteList.append((tmpFile, filename))
+
+    def _replaceFiles(self):
+        """Rename the temporary files written by _writeFile() into place.
+           The old file is kept as the "-" backup file by a hard link, no data is copied."""
+
+        etcDir = os.path.join(self.dirPrefix, "etc")
+        replacedList = []                       # (account file, whether it has a backup)
+        try:
+            while len(self.pendingWriteList) > 0:
+                tmpFile, filename = self.pendingWriteList[0]
+                hasBackup = os.path.exists(filename)
+                if hasBackup:
+                    if os.path.lexists(filename + "-"):
+                        os.unlink(filename + "-")
+                    os.link(filename, filename + "-")
+                os.rename(tmpFile, filename)
+                replacedList.append((filename, hasBackup))
+                self.pendingWriteList.pop(0)
+                if self.fsyncPolicy == FSYNC_PER_FILE:
+                    self._fsyncDir(etcDir)
+            if self.fsyncPolicy == FSYNC_PER_COMMIT:
+                self._fsyncDir(etcDir)
+        except BaseException:
+            self._restoreFiles(replacedList)
+            raise
+        finally:
+            self._discardFiles()
+
+    def _restoreFiles(self, replacedList):
+        """Put back the account files replaced by a failed _replaceFiles(), so that they are consistent with each other.
+           If that fails too, all the tables are written by the next commit."""
+
+        try:
+            for filename, hasBackup in reversed(replacedList):
+                if hasBackup:
+                    os.rename(filename + "-", filename)
+                else:
+                    os.unlink(filename)
+        except OSError:
+            self._markFilesUnknown()
+
+    def _markFilesUnknown(self):
+        self.filesUnknown = True
+        self.dirtySet = set(self._tableList)
+        self.baseIdentity = None
+
+    def _discardFiles(self):
+        for tmpFile, filename in self.pendingWriteList:
+            os.unlink(tmpFile)
+        self.pendingWriteList = []
+
+    def _fsyncDir(self, dirname):
+        fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
 
     def _pwd2str(self, e):
         return "%s:%s:%d:%d:%s:%s:%s" % (e.pw_name, "x", e.pw_uid, e.pw_gid, e.pw_gecos, e.pw_dir, e.pw_shell)
 
     def _grp2str(self, e):
-        return "%s:%s:%d:%s" % (e.gr_name, "x", e.gr_gid, e.gr_mem)
+        return "%s:%s:%d:%s" % (e.gr_name, "x", e.gr_gid, ",".join(self.groupMemberDict[e.gr_name]))
 
     def _sh2str(self, e):
         return "%s:%s:::::::" % (e.sh_name, e.sh_encpwd)
@@ -713,242 +1933,429 @@ class PasswdGroupShadow:
 
     def _verifyStage1(self):
         """account files are not fixable, and strict_pgs is not usable if stage1 verification fails"""
+        self._raiseFirst(self._checkStage1())
+
+    def _verifyStage1Shadow(self):
+        """the part of stage1 verification which needs /etc/shadow"""
+        self._raiseFirst(self._checkStage1Shadow())
+
+    def _verifyStage2(self):
+        """account files are not fixable, but strict_pgs is usable if stage2 verification fails"""
+        self._raiseFirst(self._checkStage2())
+
+    def _verifyStage3(self):
+        """strict_pgs is usable if stage3 verification fails, and most of the problems are fixed by committing"""
+        self._raiseFirst(self._checkStage3())
+
+    @staticmethod
+    def _raiseFirst(problemIter):
+        for problem in problemIter:
+            raise PgsFormatError(problem[1])
+
+    @staticmethod
+    def _isSorted(valueIter):
+        prev = None
+        for v in valueIter:
+            if prev is not None and v < prev:
+                return False
+            prev = v
+        return True
+
+    def _checkStage1(self):
+        """yields (entity, message) for each problem, so are the other _checkStage*() methods except that stage3 adds fixable"""
 
         # check system user list
         if set(self.systemUserList) != set(self._stdSystemUserList):
-            raise PgsFormatError("Invalid system user list")
-        for uname in self.systemUserList:
-            if uname not in self.shDict:
-                raise PgsFormatError("No shadow entry for system user %s" % (uname))
+            yield (None, "Invalid system user list")
 
         # check normal user list
         for uname in self.normalUserList:
-            if not (self.uidMin <= self.pwdDict[uname].pw_uid < self.uidMax):
-                raise PgsFormatError("User ID out of range for normal user %s" % (uname))
-            if self.pwdDict[uname].pw_uid != self.grpDict[uname].gr_gid:
-                raise PgsFormatError("User ID and group ID not equal for normal user %s" % (uname))
-            if len(self.shDict[uname].sh_encpwd) <= 4:
-                raise PgsFormatError("No password for normal user %s" % (uname))
-            if uname not in self.shDict:
-                raise PgsFormatError("No shadow entry for normal user %s" % (uname))
+            yield from self._checkNormalUser(uname)
 
         # check system group list
         if set(self.systemGroupList) != set(self._stdSystemGroupList):
-            raise PgsFormatError("Invalid system group list")
+            yield (None, "Invalid system group list")
 
         # check per-user group list
         if set(self.perUserGroupList) != set(self.normalUserList):
-            raise PgsFormatError("Invalid per-user group list")
+            yield (None, "Invalid per-user group list")
 
         # check stand-alone group list
         for gname in self.standAloneGroupList:
-            if not (self.gidMin <= self.grpDict[gname].gr_gid < self.gidMax):
-                raise PgsFormatError("Group ID out of range for stand-alone group %s" % (gname))
+            yield from self._checkStandAloneGroup(gname)
 
-    def _verifyStage2(self):
-        """account files are not fixable, but strict_pgs is usable if stage2 verification fails"""
-
-        if len(self.shDict["root"].sh_encpwd) <= 4 and len(self.normalUserList) == 0:
-            raise PgsFormatError("Not any user can login")
+        # check shadow entries, deferred until shadow is parsed in lazy mode
+        if "shadow" not in self.lazyTableSet:
+            yield from self._checkStage1Shadow()
 
-    def _verifyStage3(self):
-        """account files are fixable if stage3 verification fails"""
+    def _checkStage1Shadow(self):
+        for uname in self.systemUserList:
+            if uname not in self.shDict:
+                yield (uname, "No shadow entry for system user %s" % (uname))
 
-        # check system user list
-        if self.systemUserList != self._stdSystemUserList:
-            raise PgsFormatError("Invalid system user order")
+        for uname in self.normalUserList:
+            yield from self._checkNormalUserShadow(uname)
+
+    # checks of a single entity below are shared by the full and the incremental verification
+
+    def _checkNormalUser(self, uname):
+        if not (self.uidMin <= self.pwdDict[uname].pw_uid < self.uidMax):
+            yield (uname, "User ID out of range for normal user %s" % (uname))
+        if uname not in self.grpDict or self.pwdDict[uname].pw_uid != self.grpDict[uname].gr_gid:
+            yield (uname, "User ID and group ID not equal for normal user %s" % (uname))
+
+    def _checkNormalUserShadow(self, uname):
+        if uname not in self.shDict:
+            yield (uname, "No shadow entry for normal user %s" % (uname))
+        elif uname not in self.pendingPwdSet and len(self.shDict[uname].sh_encpwd) <= 4:
+            yield (uname, "No password for normal user %s" % (uname))
+
+    def _checkStandAloneGroup(self, gname):
+        if not (self.gidMin <= self.grpDict[gname].gr_gid < self.gidMax):
+            yield (gname, "Group ID out of range for stand-alone group %s" % (gname))
+
+    def _checkSystemUsers(self):
+        # stage3, the system user list is tiny
+        if list(self.systemUserList) != self._stdSystemUserList:
+            yield (None, "Invalid system user order", True)
         for uname in self.systemUserList:
             if self.pwdDict[uname].pw_gecos != "":
-                raise PgsFormatError("No comment is allowed for system user %s" % (uname))
+                yield (uname, "No comment is allowed for system user %s" % (uname), True)
+
+    def _checkNormalUserComment(self, uname):
+        # stage3
+        if self.pwdDict[uname].pw_gecos != "":
+            yield (uname, "No comment is allowed for normal user %s" % (uname), True)
+
+    def _checkSecondaryGroups(self, uname, grpSet):
+        # stage3
+        for gname in grpSet:
+            if gname in self.deprecatedGroupList:
+                yield (uname, "User %s is a member of deprecated group %s" % (uname, gname), False)
+
+    def _checkGroupFiles(self):
+        # stage3, problems of /etc/group and /etc/gshadow which are not about a single user
+        if "root" in self.userGroupDict:
+            yield ("root", "User root should not have any secondary group", True)
+        for gname in self.groupMemberFlawSet:
+            yield (gname, "Member field of group %s has flaws" % (gname), True)
+        if not os.path.exists(self.gshadowFile):
+            yield (None, "gshadow file does not exist", True)
+        elif os.path.getsize(self.gshadowFile) > 0:
+            yield (None, "gshadow file should be empty", True)
+
+    def _checkSubIdEntry(self, uname, obj, subIdMin, subIdMax, subIdCount, kind):
+        # stage3, kind is "User" or "Group"
+        if not (subIdMin <= obj.start < subIdMax):
+            yield (uname, "Subordinate %s ID out of range for user %s" % (kind, uname), True)
+        if (obj.start - subIdMin) % subIdCount != 0:
+            yield (uname, "Subordinate %s ID is not aligned for user %s" % (kind, uname), True)
+        if obj.count != subIdCount:
+            yield (uname, "Subordinate %s ID count is different from %s for user %s" % (kind, self.loginDefFile, uname), True)
+
+    def _checkStage2(self):
+        if "root" in self.shDict and len(self.shDict["root"].sh_encpwd) <= 4 and len(self.normalUserList) == 0:
+            yield (None, "Not any user can login")
+
+    def _checkStage3(self):
+        """yields (entity, message, fixable) for each problem, fixable is whether _fixate() fixes it"""
+
+        # check system user list
+        yield from self._checkSystemUsers()
 
         # check normal user list
-        uidList = [self.pwdDict[x].pw_uid for x in self.normalUserList]
-        if uidList != sorted(uidList):
-            raise PgsFormatError("Invalid normal user order")
+        if not self._isSorted(self.pwdDict[x].pw_uid for x in self.normalUserList):
+            yield (None, "Invalid normal user order", True)
         for uname in self.normalUserList:
-            if self.pwdDict[uname].pw_gecos != "":
-                raise PgsFormatError("No comment is allowed for normal user %s" % (uname))
+            yield from self._checkNormalUserComment(uname)
 
         # check software user list
         for uname in self.softwareUserList:
             if self.pwdDict[uname].pw_uid >= self.uidMin:
-                raise PgsFormatError("User ID out of range for software user %s" % (uname))
+                yield (uname, "User ID out of range for software user %s" % (uname), False)
             if self.pwdDict[uname].pw_shell != "/sbin/nologin":
-                raise PgsFormatError("Invalid shell for software user %s" % (uname))
+                yield (uname, "Invalid shell for software user %s" % (uname), True)
             if uname in self.shDict:
-                raise PgsFormatError("Should not have shadow entry for software user %s" % (uname))
+                yield (uname, "Should not have shadow entry for software user %s" % (uname), True)
 
         # check stand-alone group list
-        gidList = [self.grpDict[x].gr_gid for x in self.standAloneGroupList]
-        if gidList != sorted(gidList):
-            raise PgsFormatError("Invalid stand-alone group order")
+        if not self._isSorted(self.grpDict[x].gr_gid for x in self.standAloneGroupList):
+            yield (None, "Invalid stand-alone group order", True)
 
         # check software group list
         for gname in self.softwareGroupList:
             if self.grpDict[gname].gr_gid >= self.gidMin:
-                raise PgsFormatError("Group ID out of range for software group %s" % (gname))
-
-        # check secondary groups for root
-        if "root" in self.secondaryGroupsDict:
-            raise PgsFormatError("User root should not have any secondary group")
+                yield (gname, "Group ID out of range for software group %s" % (gname), False)
 
         # check secondary groups dict
-        for uname, grpList in self.secondaryGroupsDict.items():
-            if uname not in self.systemUserList + self.normalUserList + self.softwareUserList:
+        for uname, grpSet in self.userGroupDict.items():
+            if uname not in self.systemUserList and uname not in self.normalUserList and uname not in self.softwareUserList:
                 continue
-            for gname in grpList:
-                if gname in self.deprecatedGroupList:
-                    raise PgsFormatError("User %s is a member of deprecated group %s" % (uname, gname))
+            yield from self._checkSecondaryGroups(uname, grpSet)
 
-        # check group member field
-        for gname, g in self.grpDict.items():
-            ulist = [x for x in g.gr_mem.split(",") if x != ""]
-            if g.gr_mem != ",".join(ulist):
-                raise PgsFormatError("Member field of group %s has flaws" % (gname))
+        # check secondary groups for root, group member field and /etc/gshadow
+        yield from self._checkGroupFiles()
 
         # check /etc/shadow
-        i = 0
-        if self.systemUserList != self.shadowEntryList[i:i + len(self.systemUserList)]:
-            raise PgsFormatError("Invalid shadow file entry order")
-        i += len(self.systemUserList)
-        if self.normalUserList != self.shadowEntryList[i:i + len(self.normalUserList)]:
-            raise PgsFormatError("Invalid shadow file entry order")
-        i += len(self.normalUserList)
-        if i != len(self.shadowEntryList):
-            raise PgsFormatError("Redundant shadow file entries")
-
-        # check /etc/gshadow
-        if not os.path.exists(self.gshadowFile):
-            raise PgsFormatError("gshadow file does not exist")
-        if len(pathlib.Path(self.gshadowFile).read_text()) > 0:
-            raise PgsFormatError("gshadow file should be empty")
+        it = iter(self.shadowEntryList)
+        if list(self.systemUserList) != list(itertools.islice(it, len(self.systemUserList))):
+            yield (None, "Invalid shadow file entry order", True)
+        elif list(self.normalUserList) != list(itertools.islice(it, len(self.normalUserList))):
+            yield (None, "Invalid shadow file entry order", True)
+        elif next(it, None) is not None:
+            yield (None, "Redundant shadow file entries", True)
 
         # check subuid entry list
-        i = 0
-        if self.normalUserList != self.subUidEntryList[i:i + len(self.normalUserList)]:
-            raise PgsFormatError("Invalid subuid file entry order")
-        i += len(self.normalUserList)
-        if self.softwareUserList != self.subUidEntryList[i:i + len(self.softwareUserList)]:
-            raise PgsFormatError("Invalid subuid file entry order")
-        i += len(self.softwareUserList)
-        if i != len(self.subUidEntryList):
-            raise PgsFormatError("Redundant subuid file entries")
+        it = iter(self.subUidEntryList)
+        if list(self.normalUserList) != list(itertools.islice(it, len(self.normalUserList))):
+            yield (None, "Invalid subuid file entry order", True)
+        elif list(self.softwareUserList) != list(itertools.islice(it, len(self.softwareUserList))):
+            yield (None, "Invalid subuid file entry order", True)
+        elif next(it, None) is not None:
+            yield (None, "Redundant subuid file entries", True)
 
         # check subuid value range
         for uname, obj in self.subUidDict.items():
-            if not (self.subUidMin <= obj.start < self.subUidMax):
-                raise PgsFormatError("Subordinate User ID out of range for user %s" % (uname))
-            if (obj.start - self.subUidMin) % self.subUidCount != 0:
-                raise PgsFormatError("Subordinate User ID is not aligned for user %s" % (uname))
-            if obj.count != self.subUidCount:
-                raise PgsFormatError("Subordinate User ID count is different from %s for user %s" % (self.loginDefFile, uname))
+            yield from self._checkSubIdEntry(uname, obj, self.subUidMin, self.subUidMax, self.subUidCount, "User")
 
         # check subgid entry list
         if self.subUidEntryList != self.subGidEntryList:
-            raise PgsFormatError("Invalid subgid file entries")
+            yield (None, "Invalid subgid file entries", True)
 
         # check subgid value range
         for uname, obj in self.subGidDict.items():
-            if not (self.subGidMin <= obj.start < self.subGidMax):
-                raise PgsFormatError("Subordinate Group ID out of range for user %s" % (uname))
-            if (obj.start - self.subGidMin) % self.subGidCount != 0:
-                raise PgsFormatError("Subordinate Group ID is not aligned for user %s" % (uname))
-            if obj.count != self.subGidCount:
-                raise PgsFormatError("Subordinate Group ID count is different from %s for user %s" % (self.loginDefFile, uname))
+            yield from self._checkSubIdEntry(uname, obj, self.subGidMin, self.subGidMax, self.subGidCount, "Group")
+
+    @staticmethod
+    def _tail(orderedSet, n):
+        """returns the last n elements as a list"""
+        ret = list(itertools.islice(reversed(orderedSet), n))
+        ret.reverse()
+        return ret
+
+    def _checkStage1Touched(self):
+        """Same as _checkStage1() but only checks touched entities, stage1 must be passed when nothing was touched.
+           Mutators don't touch the system lists, and keep the per-user group list the same as normal user list
+           if they have the same length and agree on every touched user."""
+
+        if len(self.perUserGroupList) != len(self.normalUserList):
+            yield (None, "Invalid per-user group list")
+
+        for uname in self.touchedUserSet:
+            if uname in self.normalUserList:
+                if uname not in self.perUserGroupList:
+                    yield (None, "Invalid per-user group list")
+                yield from self._checkNormalUser(uname)
+                if "shadow" not in self.lazyTableSet:
+                    yield from self._checkNormalUserShadow(uname)
+            elif uname in self.perUserGroupList:
+                yield (None, "Invalid per-user group list")
+
+        for gname in self.touchedGroupSet:
+            if gname in self.standAloneGroupList:
+                yield from self._checkStandAloneGroup(gname)
+
+    def _checkStage3Touched(self):
+        """Same as _checkStage3() but only checks touched entities, stage3 must be passed when nothing was touched.
+           Mutators only append to and remove from the lists, and _fixate() puts them in order, so the order
+           can only be broken in the last n elements where n is the number of touched entities."""
+
+        n = len(self.touchedUserSet)
+
+        # check system user list
+        yield from self._checkSystemUsers()
+
+        # check normal user list
+        normalTail = self._tail(self.normalUserList, n + 1)
+        if not self._isSorted(self.pwdDict[x].pw_uid for x in normalTail):
+            yield (None, "Invalid normal user order", True)
+        for uname in self.touchedUserSet:
+            if uname in self.normalUserList:
+                yield from self._checkNormalUserComment(uname)
+
+        # check stand-alone group list
+        if not self._isSorted(self.grpDict[x].gr_gid for x in self._tail(self.standAloneGroupList, len(self.touchedGroupSet) + 1)):
+            yield (None, "Invalid stand-alone group order", True)
+
+        # check secondary groups
+        for uname in self.touchedUserSet:
+            yield from self._checkSecondaryGroups(uname, self.userGroupDict.get(uname, []))
+
+        # check secondary groups for root, group member field and /etc/gshadow
+        yield from self._checkGroupFiles()
+
+        # check /etc/shadow
+        normalTail = normalTail[1:] if len(normalTail) > n else normalTail
+        shadowNum = len(self.systemUserList) + len(self.normalUserList)
+        if len(self.shadowEntryList) < shadowNum or self._tail(self.shadowEntryList, len(normalTail)) != normalTail:
+            yield (None, "Invalid shadow file entry order", True)
+        elif len(self.shadowEntryList) > shadowNum:
+            yield (None, "Redundant shadow file entries", True)
+
+        # check subuid and subgid entry list
+        subTail = normalTail + list(self.softwareUserList)
+        subNum = len(self.normalUserList) + len(self.softwareUserList)
+        if len(self.subUidEntryList) < subNum or self._tail(self.subUidEntryList, len(subTail)) != subTail:
+            yield (None, "Invalid subuid file entry order", True)
+        elif len(self.subUidEntryList) > subNum:
+            yield (None, "Redundant subuid file entries", True)
+        if len(self.subGidEntryList) != len(self.subUidEntryList) or self._tail(self.subGidEntryList, len(subTail)) != self._tail(self.subUidEntryList, len(subTail)):
+            yield (None, "Invalid subgid file entries", True)
+
+        # check subuid and subgid value range
+        for uname in self.touchedUserSet:
+            if uname in self.subUidDict:
+                yield from self._checkSubIdEntry(uname, self.subUidDict[uname], self.subUidMin, self.subUidMax, self.subUidCount, "User")
+            if uname in self.subGidDict:
+                yield from self._checkSubIdEntry(uname, self.subGidDict[uname], self.subGidMin, self.subGidMax, self.subGidCount, "Group")
 
     def _fixate(self):
         # sort system user list
         assert set(self.systemUserList) == set(self._stdSystemUserList)
-        self.systemUserList = self._stdSystemUserList
+        self._setAttr(self, "systemUserList", _OrderedSet(self._stdSystemUserList))
 
         # remove comment for system users
         for uname in self.systemUserList:
-            self.pwdDict[uname].pw_gecos = ""
+            if self.pwdDict[uname].pw_gecos != "":
+                self._setAttr(self.pwdDict[uname], "pw_gecos", "")
 
         # sort normal user list
-        self.normalUserList.sort(key=lambda x: self.pwdDict[x].pw_uid)
+        self._listSort(self.normalUserList, key=lambda x: self.pwdDict[x].pw_uid)
 
         # remove comment for normal users
         for uname in self.normalUserList:
-            self.pwdDict[uname].pw_gecos = ""
+            if self.pwdDict[uname].pw_gecos != "":
+                self._setAttr(self.pwdDict[uname], "pw_gecos", "")
 
         # standardize shell for software users
         for uname in self.softwareUserList:
-            self.pwdDict[uname].pw_shell = "/sbin/nologin"
+            if self.pwdDict[uname].pw_shell != "/sbin/nologin":
+                self._setAttr(self.pwdDict[uname], "pw_shell", "/sbin/nologin")
+        self._invalidateUserIndex()
 
         # remove shadow entry for software users
         for uname in self.softwareUserList:
             if uname in self.shDict:
-                del self.shDict[uname]
+                self._delItem(self.shDict, uname)
 
         # sort system group list
         assert set(self.systemGroupList) == set(self._stdSystemGroupList)
-        self.systemGroupList = self._stdSystemGroupList
+        self._setAttr(self, "systemGroupList", _OrderedSet(self._stdSystemGroupList))
 
         # sort per-user group list
         assert set(self.perUserGroupList) == set(self.normalUserList)
-        self.perUserGroupList = self.normalUserList
+        self._setAttr(self, "perUserGroupList", _OrderedSet(self.normalUserList))
 
         # sort stand-alone group list
-        self.standAloneGroupList.sort(key=lambda x: self.grpDict[x].pw_gid)
+        self._listSort(self.standAloneGroupList, key=lambda x: self.grpDict[x].gr_gid)
 
         # remove root from any secondary group
-        if "root" in self.secondaryGroupsDict:
-            del self.secondaryGroupsDict["root"]
-        for entry in self.grpDict.values():
-            ulist = [x for x in entry.gr_mem.split(",") if x != ""]
-            if "root" in ulist:
-                ulist.remove("root")
-                entry.gr_mem = ",".join(ulist)
-
-        # standardize group members
-        for g in self.grpDict.values():
-            ulist = [x for x in g.gr_mem.split(",") if x != ""]
-            g.gr_mem = ",".join(ulist)
+        for gname in list(self.userGroupDict.get("root", [])):
+            self._removeGroupMember(gname, "root")
+
+        # standardize group members, the member field is re-generated from groupMemberDict when writing
+        if len(self.groupMemberFlawSet) > 0:
+            self._setAttr(self, "groupMemberFlawSet", set())
 
         # sort shadow entry list
-        assert set(self.shadowEntryList) >= set(self.systemUserList + self.normalUserList)
-        self.shadowEntryList = self.systemUserList + self.normalUserList
+        assert all(x in self.shadowEntryList for x in itertools.chain(self.systemUserList, self.normalUserList))
+        self._setAttr(self, "shadowEntryList", _OrderedSet(itertools.chain(self.systemUserList, self.normalUserList)))
 
         # remove redundant shadow entries
         for uname in set(self.shDict.keys()) - set(self.shadowEntryList):
-            del self.shDict[uname]
+            self._delItem(self.shDict, uname)
 
         # sort subuid entry list
-        self.subUidEntryList = self.normalUserList + self.softwareUserList
+        self._setAttr(self, "subUidEntryList", _OrderedSet(itertools.chain(self.normalUserList, self.softwareUserList)))
 
         # remove redundant subuid entries
         for uname in set(self.subUidDict.keys()) - set(self.subUidEntryList):
-            del self.subUidDict[uname]
+            self._releaseSubIds(self.subUidAllocator, self.subUidDict[uname].start, self.subUidDict[uname].count)
+            self._delItem(self.subUidDict, uname)
 
         # add missing subuid entries, fix invalid subuid entries
         for uname in self.subUidEntryList:
-            if uname not in self.subUidDict or not (self.subUidMin <= self.subUidDict[uname].start < self.subUidMax) or (self.subUidDict[uname].start - self.subUidMin) % self.subUidCount != 0 or self.subUidDict[uname].count != self.subUidCount:
-                slist = [x.start for x in self.subUidDict.values()]
-                for s in range(self.subUidMin, self.subUidMax, self.subUidCount):
-                    if s not in slist:
-                        self.subUidDict[uname] = self._SubUidGidEntry(uname, s, self.subUidCount)
-                        break
-                else:
-                    assert False
+            if uname not in self.subUidDict or not self.subUidAllocator.isValid(self.subUidDict[uname].start, self.subUidDict[uname].count):
+                s = self._allocateSubIds(self.subUidAllocator)
+                assert s is not None
+                self._setItem(self.subUidDict, uname, self._SubUidGidEntry(uname, s, self.subUidCount))
 
         # sort subgid entry list
-        self.subGidEntryList = list(self.subUidEntryList)
+        self._setAttr(self, "subGidEntryList", _OrderedSet(self.subUidEntryList))
 
         # remove redundant subgid entries
         for uname in set(self.subGidDict.keys()) - set(self.subGidEntryList):
-            del self.subGidDict[uname]
+            self._releaseSubIds(self.subGidAllocator, self.subGidDict[uname].start, self.subGidDict[uname].count)
+            self._delItem(self.subGidDict, uname)
 
         # add missing subgid entries, fix invalid subgid entries
         for uname in self.subGidEntryList:
-            if uname not in self.subGidDict or not (self.subGidMin <= self.subGidDict[uname].start < self.subGidMax) or (self.subGidDict[uname].start - self.subGidMin) % self.subGidCount != 0 or self.subGidDict[uname].count != self.subGidCount:
-                slist = [x.start for x in self.subGidDict.values()]
-                for s in range(self.subGidMin, self.subGidMax, self.subGidCount):
-                    if s not in slist:
-                        self.subGidDict[uname] = self._SubUidGidEntry(uname, s, self.subGidCount)
-                        break
-                else:
-                    assert False
+            if uname not in self.subGidDict or not self.subGidAllocator.isValid(self.subGidDict[uname].start, self.subGidDict[uname].count):
+                s = self._allocateSubIds(self.subGidAllocator)
+                assert s is not None
+                self._setItem(self.subGidDict, uname, self._SubUidGidEntry(uname, s, self.subGidCount))
+
+        self._invalidateSubIdIndex()
+
+    def _exportCdb(self):
+        # passwd.cdb
+        source = self._cdbSource(self.baseIdentity[0:2])
+        if not self._cdbUpToDate(self.passwdCdbFile, source):
+            itemList = [("#version", self._cdbVersion), ("#source", source)]
+            for uname, e in self.pwdDict.items():
+                itemList.append(("." + uname, self._pwd2str(e)))
+            for uid, uname in self.uidDict.items():
+                itemList.append(("=%d" % (uid), self._pwd2str(self.pwdDict[uname])))
+            for category, attr in self._userCategoryDict.items():
+                itemList.append(("#" + category, ",".join(getattr(self, attr))))
+            self._writeCdb(self.passwdCdbFile, itemList)
+
+        # group.cdb
+        source = self._cdbSource(self.baseIdentity[0:3])
+        if not self._cdbUpToDate(self.groupCdbFile, source):
+            itemList = [("#version", self._cdbVersion), ("#source", source)]
+            for gname, e in self.grpDict.items():
+                itemList.append(("." + gname, self._grp2str(e)))
+            for gid, gname in self.gidDict.items():
+                itemList.append(("=%d" % (gid), self._grp2str(self.grpDict[gname])))
+            for uname, grpSet in self.userGroupDict.items():
+                itemList.append((":" + uname, ",".join(sorted(grpSet))))
+            for category, attr in self._groupCategoryDict.items():
+                itemList.append(("#" + category, ",".join(getattr(self, attr))))
+            self._writeCdb(self.groupCdbFile, itemList)
+
+    @staticmethod
+    def _cdbSource(fileIdentity):
+        return ",".join("%d:%d:%d" % x if x is not None else "-" for x in fileIdentity)
+
+    def _cdbUpToDate(self, filename, source):
+        try:
+            with _CdbReader(filename) as db:
+                return db.get("#version") == self._cdbVersion and db.get("#source") == source
+        except (FileNotFoundError, PgsFormatError):
+            return False
+
+    def _writeCdb(self, filename, itemList):
+        """unlike account files, cdb files are written into place without keeping a backup"""
+
+        fd, tmpFile = tempfile.mkstemp(prefix=".%s." % (os.path.basename(filename)), dir=os.path.dirname(filename))
+        try:
+            os.fchmod(fd, 0o644)
+            with os.fdopen(fd, "wb") as f:
+                fd = None
+                f.write(_cdbBuild(itemList))
+                if self.fsyncPolicy != FSYNC_NONE:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.rename(tmpFile, filename)
+        except BaseException:
+            if fd is not None:
+                os.close(fd)
+            if os.path.exists(tmpFile):
+                os.unlink(tmpFile)
+            raise
+        if self.fsyncPolicy != FSYNC_NONE:
+            self._fsyncDir(os.path.dirname(filename))
 
     def _nonEmptySplit(theStr, delimiter):
         ret = []
@@ -958,21 +2365,29 @@ class PasswdGroupShadow:
         return ret
 
     def _lockPwd(self):
-        """Use the same implementation as lckpwdf() in glibc"""
+        """Use the same implementation as lckpwdf() in glibc, except that the time budget is self.lockTimeout
+           and the interval between attempts grows exponentially from 1ms, so that short contention is cheap."""
 
         assert self.lockFd is None
         self.lockFd = os.open(self.lockFile, os.O_WRONLY | os.O_CREAT | os.O_CLOEXEC, 0o600)
         try:
-            t = datetime.now()
-            while (datetime.now() - t).total_seconds() < 15.0:
+            t = time.monotonic()
+            interval = self._lockIntervalMin
+            while True:
                 try:
                     fcntl.lockf(self.lockFd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    self.lockWaitTime = time.monotonic() - t
                     return
                 except IOError as e:
-                    if e.errno != errno.EACCESS and e.errno != errno.EAGAIN:
+                    if e.errno != errno.EACCES and e.errno != errno.EAGAIN:
                         raise
-                time.sleep(1.0)
-            raise PgsLockError("Failed to acquire lock")
+                remaining = self.lockTimeout - (time.monotonic() - t)
+                if remaining <= 0:
+                    self.lockWaitTime = time.monotonic() - t
+                    raise PgsLockError("Failed to acquire lock")
+                time.sleep(min(interval, remaining))
+                interval = min(interval * 2, self._lockIntervalMax)
+                self.lockRetries += 1
         except Exception:
             os.close(self.lockFd)
             self.lockFd = None
@@ -984,3 +2399,390 @@ class PasswdGroupShadow:
         assert self.lockFd is not None
         os.close(self.lockFd)
         self.lockFd = None
+
+
+class MappedPasswdGroupShadow:
+    """Read-only view of the cdb files exported by PasswdGroupShadow.exportCdb(), use PasswdGroupShadow.openMapped()
+       instead of creating it directly. The query methods are the same as PasswdGroupShadow, results are not
+       cached except the user and group lists. There's no index for queryUsers() and queryGroups(), they decode
+       the entries of all the candidates."""
+
+    def __init__(self, dirPrefix="/"):
+        self.valid = True
+        self.loginDefFile = os.path.join(dirPrefix, "etc", "login.defs")
+        self.passwdFile = os.path.join(dirPrefix, "etc", "passwd")
+        self.groupFile = os.path.join(dirPrefix, "etc", "group")
+        self.listCache = dict()                 # key: (cdb, category); value: list of names
+
+        self.passwdDb = _CdbReader(os.path.join(dirPrefix, "etc", "passwd.cdb"))
+        try:
+            self.groupDb = _CdbReader(os.path.join(dirPrefix, "etc", "group.cdb"))
+        except BaseException:
+            self.passwdDb.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def isOutOfDate(self):
+        """returns True if the account files are changed since the cdb files are exported"""
+        assert self.valid
+        for db, fileList in [(self.passwdDb, [self.loginDefFile, self.passwdFile]),
+                             (self.groupDb, [self.loginDefFile, self.passwdFile, self.groupFile])]:
+            if db.get("#version") != PasswdGroupShadow._cdbVersion:
+                return True
+            if db.get("#source") != PasswdGroupShadow._cdbSource(_statFileList(fileList)):
+                return True
+        return False
+
+    def getSystemUserList(self):
+        """returns system user name list"""
+        return self._getList(self.passwdDb, "system")
+
+    def getNormalUserList(self):
+        """returns normal user name list"""
+        return self._getList(self.passwdDb, "normal")
+
+    def getSystemGroupList(self):
+        """returns system group name list"""
+        return self._getList(self.groupDb, "system")
+
+    def getStandAloneGroupList(self):
+        """returns stand-alone group name list"""
+        return self._getList(self.groupDb, "stand-alone")
+
+    def getSoftwareGroupList(self):
+        """returns software group name list"""
+        return self._getList(self.groupDb, "software")
+
+    def getSecondaryGroupsOfUser(self, username):
+        """returns group name list"""
+        assert self.valid
+        assert username in self._getCachedList(self.passwdDb, "normal")
+        value = self.groupDb.get(":" + username)
+        if value is None:
+            return []
+        return value.split(",")
+
+    def queryUsers(self, category=None, shell=None, homePrefix=None, groups=None, anyGroups=None):
+        """same as PasswdGroupShadow.queryUsers()"""
+        assert self.valid
+
+        if category is not None:
+            if category not in PasswdGroupShadow._userCategoryDict:
+                raise KeyError(category)
+            ret = set(self._getCachedList(self.passwdDb, category))
+        else:
+            ret = set()
+            for c in PasswdGroupShadow._userCategoryDict:
+                ret.update(self._getCachedList(self.passwdDb, c))
+        if groups is not None:
+            for gname in groups:
+                ret &= self._getMemberSet(gname)
+        if anyGroups is not None:
+            unionSet = set()
+            for gname in anyGroups:
+                unionSet |= self._getMemberSet(gname)
+            ret &= unionSet
+        if shell is not None or homePrefix is not None:
+            for uname in list(ret):
+                fields = self.passwdDb.get("." + uname).split(":")
+                if shell is not None and fields[6] != shell:
+                    ret.remove(uname)
+                elif homePrefix is not None and not fields[5].startswith(homePrefix):
+                    ret.remove(uname)
+        return ret
+
+    def queryGroups(self, category=None, member=None):
+        """same as PasswdGroupShadow.queryGroups()"""
+        assert self.valid
+
+        if category is not None:
+            if category not in PasswdGroupShadow._groupCategoryDict:
+                raise KeyError(category)
+            ret = set(self._getCachedList(self.groupDb, category))
+        else:
+            ret = set()
+            for c in PasswdGroupShadow._groupCategoryDict:
+                ret.update(self._getCachedList(self.groupDb, c))
+        if member is not None:
+            value = self.groupDb.get(":" + member)
+            ret &= set(value.split(",")) if value is not None else set()
+        return ret
+
+    def getUserByUid(self, uid):
+        """returns user name, None if not found"""
+        assert self.valid
+        return self._lineToName(self.passwdDb.get("=%d" % (uid)))
+
+    def getGroupByGid(self, gid):
+        """returns group name, None if not found"""
+        assert self.valid
+        return self._lineToName(self.groupDb.get("=%d" % (gid)))
+
+    def resolveUids(self, uids):
+        """returns a dict which maps every uid to its user name, None for uid not found"""
+        return {x: self.getUserByUid(x) for x in uids}
+
+    def resolveGids(self, gids):
+        """returns a dict which maps every gid to its group name, None for gid not found"""
+        return {x: self.getGroupByGid(x) for x in gids}
+
+    def ownerOfSubUid(self, id):
+        raise NotImplementedError("Subordinate user ids are not exported to cdb files")
+
+    def ownerOfSubGid(self, id):
+        raise NotImplementedError("Subordinate group ids are not exported to cdb files")
+
+    def findSubUidOverlaps(self, start, count):
+        raise NotImplementedError("Subordinate user ids are not exported to cdb files")
+
+    def findSubGidOverlaps(self, start, count):
+        raise NotImplementedError("Subordinate group ids are not exported to cdb files")
+
+    def verify(self):
+        raise NotImplementedError("Verification needs the account files, use PasswdGroupShadow")
+
+    def check(self):
+        raise NotImplementedError("Verification needs the account files, use PasswdGroupShadow")
+
+    def close(self):
+        assert self.valid
+        self.passwdDb.close()
+        self.groupDb.close()
+        self.valid = False
+
+    def _getList(self, db, category):
+        return list(self._getCachedList(db, category))
+
+    def _getCachedList(self, db, category):
+        assert self.valid
+        key = (id(db), category)
+        if key not in self.listCache:
+            value = db.get("#" + category)
+            if value is None:
+                raise PgsFormatError("Invalid cdb file, %s list is missing" % (category))
+            self.listCache[key] = value.split(",") if value != "" else []
+        return self.listCache[key]
+
+    def _getMemberSet(self, groupname):
+        line = self.groupDb.get("." + groupname)
+        if line is None:
+            return set()
+        value = line.split(":")[3]
+        return set(value.split(",")) if value != "" else set()
+
+    @staticmethod
+    def _lineToName(line):
+        return line.split(":", 1)[0] if line is not None else None
+
+
+class AsyncPasswdGroupShadow:
+    """asyncio front-end of PasswdGroupShadow:
+           pgs = await AsyncPasswdGroupShadow.open("/", readOnly=False)
+           async with pgs:
+               await pgs.addNormalUser(...)
+       Parsing, modifications, verification and committing are run in threads by asyncio.to_thread(), waiting for
+       the lock is done by polling with asyncio.sleep(). Queries are done in the event loop when they only read memory,
+       and in a thread when they have to parse a table not loaded yet in lazy mode.
+       Operations are serialized by an asyncio.Lock, the wrapped object is not thread safe. Tasks created inside a
+       batch() belong to the batch, their operations are serialized with the ones of the batch.
+       Encrypting passwords holds the GIL, use hashWorkers to move it out of this process."""
+
+    # cleanup of cancelled open(), referenced until it is done
+    _cleanupTaskSet = set()
+
+    def __init__(self, pgs):
+        self.pgs = pgs
+        self._lock = asyncio.Lock()             # held by a batch or by a single operation outside of a batch
+        self._opLock = asyncio.Lock()           # serializes the operations inside a batch
+        self._batchOwner = None
+        self._batchVar = contextvars.ContextVar("batchOwner", default=None)
+
+    @classmethod
+    async def open(cls, dirPrefix="/", readOnly=True, lockTimeout=15.0, **kwargs):
+        """Same arguments as PasswdGroupShadow(), lockTimeout is applied without blocking the event loop."""
+
+        if readOnly or kwargs.get("optimistic", False):
+            pgs = await cls._openInThread(PasswdGroupShadow, dirPrefix, readOnly=readOnly, lockTimeout=lockTimeout, **kwargs)
+            return cls(pgs)
+
+        t = time.monotonic()
+        interval = PasswdGroupShadow._lockIntervalMin
+        retries = 0
+        while True:
+            pgs = await cls._openInThread(PasswdGroupShadow.tryOpen, dirPrefix, **kwargs)
+            if pgs is not None:
+                break
+            remaining = lockTimeout - (time.monotonic() - t)
+            if remaining <= 0:
+                raise PgsLockError("Failed to acquire lock")
+            await asyncio.sleep(min(interval, remaining))
+            interval = min(interval * 2, PasswdGroupShadow._lockIntervalMax)
+            retries += 1
+        pgs.lockTimeout = lockTimeout
+        pgs.lockWaitTime = time.monotonic() - t
+        pgs.lockRetries = retries
+        return cls(pgs)
+
+    @classmethod
+    async def _openInThread(cls, func, *args, **kwargs):
+        """Run func, which returns a PasswdGroupShadow or None, by asyncio.to_thread(). The thread can't be cancelled,
+           so if the caller is cancelled, the object is closed when func returns, or it would keep holding the lock."""
+
+        task = asyncio.ensure_future(asyncio.to_thread(func, *args, **kwargs))
+        try:
+            return await asyncio.shield(task)
+        except asyncio.CancelledError:
+            cleanup = asyncio.ensure_future(cls._closeOpened(task))
+            cls._cleanupTaskSet.add(cleanup)
+            cleanup.add_done_callback(cls._cleanupTaskSet.discard)
+            await asyncio.shield(cleanup)
+            raise
+
+    @staticmethod
+    async def _closeOpened(task):
+        try:
+            pgs = await task
+            if pgs is not None:
+                await asyncio.to_thread(pgs.close)
+        except Exception:
+            # nothing to report to, the caller is cancelled
+            pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    async def getSystemUserList(self):
+        return await self._query(self.pgs.getSystemUserList)
+
+    async def getNormalUserList(self):
+        return await self._query(self.pgs.getNormalUserList)
+
+    async def getSystemGroupList(self):
+        return await self._query(self.pgs.getSystemGroupList)
+
+    async def getStandAloneGroupList(self):
+        return await self._query(self.pgs.getStandAloneGroupList)
+
+    async def getSoftwareGroupList(self):
+        return await self._query(self.pgs.getSoftwareGroupList)
+
+    async def getSecondaryGroupsOfUser(self, username):
+        return await self._query(self.pgs.getSecondaryGroupsOfUser, username)
+
+    async def queryUsers(self, **kwargs):
+        return await self._query(self.pgs.queryUsers, **kwargs)
+
+    async def queryGroups(self, **kwargs):
+        return await self._query(self.pgs.queryGroups, **kwargs)
+
+    async def getUserByUid(self, uid):
+        return await self._query(self.pgs.getUserByUid, uid)
+
+    async def getGroupByGid(self, gid):
+        return await self._query(self.pgs.getGroupByGid, gid)
+
+    async def resolveUids(self, uids):
+        return await self._query(self.pgs.resolveUids, uids)
+
+    async def resolveGids(self, gids):
+        return await self._query(self.pgs.resolveGids, gids)
+
+    async def ownerOfSubUid(self, id):
+        return await self._query(self.pgs.ownerOfSubUid, id)
+
+    async def ownerOfSubGid(self, id):
+        return await self._query(self.pgs.ownerOfSubGid, id)
+
+    async def findSubUidOverlaps(self, start, count):
+        return await self._query(self.pgs.findSubUidOverlaps, start, count)
+
+    async def findSubGidOverlaps(self, start, count):
+        return await self._query(self.pgs.findSubGidOverlaps, start, count)
+
+    async def verify(self):
+        return await self._run(self.pgs.verify)
+
+    async def check(self):
+        return await self._run(self.pgs.check)
+
+    async def addNormalUser(self, username, password):
+        return await self._run(self.pgs.addNormalUser, username, password)
+
+    async def removeNormalUser(self, username):
+        return await self._run(self.pgs.removeNormalUser, username)
+
+    async def modifyNormalUser(self, username, op, *kargs):
+        return await self._run(self.pgs.modifyNormalUser, username, op, *kargs)
+
+    async def addStandAloneGroup(self, groupname):
+        return await self._run(self.pgs.addStandAloneGroup, groupname)
+
+    async def removeStandAloneGroup(self, groupname):
+        return await self._run(self.pgs.removeStandAloneGroup, groupname)
+
+    @contextlib.asynccontextmanager
+    async def batch(self):
+        """Same as PasswdGroupShadow.batch(), other coroutines can't operate on this object until the batch ends."""
+        async with self._batchLocked():
+            cm = self.pgs.batch()
+            async with self._opLock:
+                await asyncio.to_thread(cm.__enter__)
+            try:
+                yield self
+            except BaseException:
+                async with self._opLock:
+                    if not await asyncio.to_thread(cm.__exit__, *sys.exc_info()):
+                        raise
+            else:
+                async with self._opLock:
+                    await asyncio.to_thread(cm.__exit__, None, None, None)
+
+    async def exportCdb(self):
+        return await self._run(self.pgs.exportCdb)
+
+    async def close(self):
+        return await self._run(self.pgs.close)
+
+    @contextlib.asynccontextmanager
+    async def _locked(self):
+        # the batch owner is kept in a context variable, which is inherited by the tasks created inside the batch
+        if self._batchOwner is not None and self._batchVar.get() is self._batchOwner:
+            async with self._opLock:
+                yield
+            return
+        async with self._lock:
+            async with self._opLock:
+                yield
+
+    @contextlib.asynccontextmanager
+    async def _batchLocked(self):
+        if self._batchOwner is not None and self._batchVar.get() is self._batchOwner:
+            yield
+            return
+        async with self._lock:
+            self._batchOwner = object()
+            token = self._batchVar.set(self._batchOwner)
+            try:
+                yield
+            finally:
+                self._batchVar.reset(token)
+                self._batchOwner = None
+
+    async def _query(self, func, *args, **kwargs):
+        async with self._locked():
+            if self.pgs.lazyTableSet:
+                # the query may parse a table
+                return await asyncio.to_thread(func, *args, **kwargs)
+            return func(*args, **kwargs)
+
+    async def _run(self, func, *args):
+        async with self._locked():
+            return await asyncio.to_thread(func, *args)
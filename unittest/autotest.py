@@ -2,8 +2,12 @@
 # -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
 
 import os
+import re
 import sys
+import asyncio
 import shutil
+import threading
+import subprocess
 import unittest
 
 curDir = os.path.dirname(os.path.abspath(__file__))
@@ -11,7 +15,9 @@ if sys.version_info >= (3, 0):
 	sys.path.insert(0, os.path.join(curDir, "../python3"))
 else:
 	sys.path.insert(0, os.path.join(curDir, "../python2"))
+import strict_pgs
 from strict_pgs import PasswdGroupShadow
+from strict_pgs import MUSER_JOIN_GROUP, MUSER_LEAVE_GROUP
 
 class ReadDataEmpty(unittest.TestCase):
 	def setUp(self):
@@ -120,6 +126,847 @@ class AddOneNormalUser(unittest.TestCase):
 		pgs2 = PasswdGroupShadow(rootDir)
 		self.assertEqual(pgs.getNormalUserList(), ["usera", "userb", "userc"])
 
+class AllocateIds(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False)
+		try:
+			pgs.addNormalUser("userc", "password")
+			self.assertEqual(pgs.pwdDict["userc"].pw_uid, 1002)
+			self.assertEqual(pgs.grpDict["userc"].gr_gid, 1002)
+			self.assertEqual(pgs.subUidDict["userc"].start, 100000)
+			self.assertEqual(pgs.subGidDict["userc"].start, 100000)
+
+			pgs.addStandAloneGroup("groupd")
+			self.assertEqual(pgs.grpDict["groupd"].gr_gid, 1003)
+
+			pgs.removeNormalUser("userb")
+			pgs.addNormalUser("userd", "password")
+			self.assertEqual(pgs.pwdDict["userd"].pw_uid, 1001)
+			self.assertEqual(pgs.subUidDict["userd"].start, 200000)
+
+			pgs.removeNormalUser("userc")
+			pgs.addNormalUser("usere", "password")
+			self.assertEqual(pgs.subUidDict["usere"].start, 100000)
+			self.assertEqual(pgs.subGidDict["usere"].start, 100000)
+
+			pgs.removeStandAloneGroup("groupd")
+			pgs.addStandAloneGroup("groupe")
+			self.assertEqual(pgs.grpDict["groupe"].gr_gid, 1003)
+		finally:
+			pgs.close()
+
+		# ids shared by duplicate entries are not released until the last entry is removed
+		etcDir = os.path.join(self.rootDir, "etc")
+		with open(os.path.join(etcDir, "passwd"), "a") as f:
+			f.write("dupa:x:1000:1000::/home/dupa:/bin/bash\n")
+		with open(os.path.join(etcDir, "group"), "a") as f:
+			f.write("dupa:x:1000:\n")
+		with open(os.path.join(etcDir, "shadow"), "a") as f:
+			f.write("dupa:$6$XXXXXXXX$XXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXXX:0::::::\n")
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as pgs:
+			uid = pgs.pwdDict["dupa"].pw_uid
+			pgs.removeNormalUser("dupa")
+			self.assertIsNotNone(pgs.getUserByUid(uid))
+			pgs.addNormalUser("userf", "password")
+			self.assertNotEqual(pgs.pwdDict["userf"].pw_uid, uid)
+
+		# no free subordinate group id range, nothing is changed
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			while pgs.subGidAllocator.allocate() is not None:
+				pass
+			firstUid = pgs.uidAllocator.firstCommon(pgs.gidAllocator)
+			firstSubUid = pgs.subUidAllocator.allocate()
+			pgs.subUidAllocator.release(firstSubUid, pgs.subUidCount)
+			with self.assertRaisesRegex(strict_pgs.PgsAddUserError, "subordinate group id"):
+				pgs.addNormalUser("userg", "password")
+			for d in [pgs.pwdDict, pgs.grpDict, pgs.shDict, pgs.subUidDict]:
+				self.assertNotIn("userg", d)
+			self.assertEqual(pgs.uidAllocator.firstCommon(pgs.gidAllocator), firstUid)
+			self.assertEqual(pgs.subUidAllocator.allocate(), firstSubUid)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class BatchCommitAndRollback(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False)
+		try:
+			with pgs.batch():
+				pgs.addStandAloneGroup("groupd")
+				pgs.removeStandAloneGroup("groupa")
+
+			with PasswdGroupShadow(self.rootDir) as pgs2:
+				self.assertEqual(pgs2.getStandAloneGroupList(), ["groupd", "groupb", "groupc"])
+
+			with self.assertRaises(RuntimeError):
+				with pgs.batch():
+					pgs.addStandAloneGroup("groupe")
+					pgs.removeStandAloneGroup("groupb")
+					raise RuntimeError()
+			self.assertEqual(pgs.getStandAloneGroupList(), ["groupd", "groupb", "groupc"])
+
+			# rolling back restores the order of lists, group members and id allocation exactly
+			def dumpState():
+				return (list(pgs.normalUserList), list(pgs.perUserGroupList), list(pgs.shadowEntryList), list(pgs.subUidEntryList),
+						{k: list(v) for k, v in pgs.groupMemberDict.items()}, {k: sorted(v) for k, v in pgs.userGroupDict.items()},
+						{k: (e.pw_uid, e.pw_gecos) for k, e in pgs.pwdDict.items()}, dict(pgs.uidDict), dict(pgs.gidDict),
+						{k: e.start for k, e in pgs.subUidDict.items()}, sorted(pgs.shDict),
+						pgs.uidAllocator.firstCommon(pgs.gidAllocator), pgs.subUidAllocator._slots.first())
+			before = dumpState()
+			with self.assertRaises(RuntimeError):
+				with pgs.batch():
+					pgs.removeNormalUser("usera")
+					pgs.addNormalUser("userg", "password")
+					pgs.modifyNormalUser("userg", MUSER_JOIN_GROUP, "groupb")
+					pgs.removeNormalUser("userg")
+					pgs.addNormalUser("usera", "password")
+					raise RuntimeError()
+			self.assertEqual(dumpState(), before)
+
+			pgs.addStandAloneGroup("groupf")
+			self.assertEqual(pgs.grpDict["groupf"].gr_gid, 1003)
+		finally:
+			pgs.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class ReplaceFilesFailure(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		groupFile = os.path.join(self.rootDir, "etc", "group")
+		realRename = os.rename
+
+		def failRename(src, dst, failBackup):
+			if dst == groupFile or (failBackup and src.endswith("-")):
+				raise OSError("rename failed")
+			realRename(src, dst)
+
+		for failBackup in [False, True]:
+			pgs = PasswdGroupShadow(self.rootDir, readOnly=False)
+			try:
+				with pgs.batch():
+					pgs.addStandAloneGroup("group%d" % (failBackup))
+
+				# passwd is replaced, then replacing group fails
+				os.rename = lambda src, dst: failRename(src, dst, failBackup)
+				try:
+					with self.assertRaises(OSError):
+						with pgs.batch():
+							pgs.addNormalUser("userc", "password")
+				finally:
+					os.rename = realRename
+				self.assertNotIn("userc", pgs.getNormalUserList())
+				if not failBackup:
+					# passwd is put back from its backup
+					with PasswdGroupShadow(self.rootDir) as pgs2:
+						self.assertNotIn("userc", pgs2.getNormalUserList())
+				else:
+					# passwd can't be put back, all the files are written by the next commit
+					self.assertEqual(len(pgs.dirtySet), 6)
+			finally:
+				pgs.close()
+
+			with PasswdGroupShadow(self.rootDir) as pgs2:
+				self.assertNotIn("userc", pgs2.getNormalUserList())
+				self.assertIn("group%d" % (failBackup), pgs2.getStandAloneGroupList())
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class ParallelPasswordHashing(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False, hashWorkers=2)
+		try:
+			pgs.addNormalUser("userc", "password")
+			pgs.addNormalUser("userd", "password")
+			pgs.addNormalUser("usere", "password")
+			pgs.removeNormalUser("usere")
+		finally:
+			pgs.close()
+
+		with PasswdGroupShadow(self.rootDir) as pgs2:
+			self.assertEqual(pgs2.getNormalUserList(), ["usera", "userb", "userc", "userd"])
+			self.assertTrue(pgs2.shDict["userc"].sh_encpwd.startswith("$6$"))
+			self.assertTrue(pgs2.shDict["userd"].sh_encpwd.startswith("$6$"))
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class ModifyGroupMembers(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False)
+		try:
+			pgs.removeStandAloneGroup("groupa")
+			self.assertEqual(pgs.getSecondaryGroupsOfUser("usera"), ["groupb", "groupc"])
+
+			pgs.modifyNormalUser("userb", MUSER_JOIN_GROUP, "groupc")
+			pgs.modifyNormalUser("userb", MUSER_JOIN_GROUP, "wheel")
+			pgs.modifyNormalUser("userb", MUSER_LEAVE_GROUP, "wheel")
+			self.assertEqual(pgs.getSecondaryGroupsOfUser("userb"), ["groupc"])
+
+			pgs.removeNormalUser("usera")
+		finally:
+			pgs.close()
+
+		with open(os.path.join(self.rootDir, "etc", "group")) as f:
+			lineList = f.read().split("\n")
+		self.assertIn("root:x:0:", lineList)
+		self.assertIn("groupb:x:5001:", lineList)
+		self.assertIn("groupc:x:5002:userb", lineList)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class AtomicCommit(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-need-convert")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		etcDir = os.path.join(self.rootDir, "etc")
+		os.chmod(os.path.join(etcDir, "shadow"), 0o600)
+		with open(os.path.join(etcDir, "passwd")) as f:
+			oldBuf = f.read()
+
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False)
+		pgs.close()
+
+		with open(os.path.join(etcDir, "passwd-")) as f:
+			self.assertEqual(f.read(), oldBuf)
+		self.assertEqual(os.stat(os.path.join(etcDir, "shadow")).st_mode & 0o777, 0o600)
+		self.assertEqual(sorted(os.listdir(etcDir)), [".pwd.lock",
+													  "group", "group-", "gshadow", "gshadow-", "login.defs",
+													  "passwd", "passwd-", "shadow", "shadow-", "subgid", "subuid"])
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class WriteChangedFilesOnly(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-need-convert")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		etcDir = os.path.join(self.rootDir, "etc")
+
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False)
+		pgs.close()
+		for fn in os.listdir(etcDir):
+			if fn.endswith("-"):
+				os.unlink(os.path.join(etcDir, fn))
+
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False)
+		pgs.modifyNormalUser("userb", MUSER_JOIN_GROUP, "wheel")
+		pgs.close()
+		self.assertEqual(sorted([x for x in os.listdir(etcDir) if x.endswith("-")]), ["group-"])
+
+		ino = os.stat(os.path.join(etcDir, "group")).st_ino
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False)
+		pgs.modifyNormalUser("userb", MUSER_JOIN_GROUP, "games")
+		pgs.modifyNormalUser("userb", MUSER_LEAVE_GROUP, "games")
+		pgs.close()
+		self.assertEqual(os.stat(os.path.join(etcDir, "group")).st_ino, ino)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class CachedReadOnlyOpen(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		with PasswdGroupShadow(self.rootDir, useCache=True) as pgs1:
+			with PasswdGroupShadow(self.rootDir, useCache=True) as pgs2:
+				self.assertIs(pgs1.pwdDict, pgs2.pwdDict)
+
+				pgs2.addStandAloneGroup("groupd")
+				self.assertEqual(pgs1.getStandAloneGroupList(), ["groupa", "groupb", "groupc"])
+				self.assertEqual(pgs2.getStandAloneGroupList(), ["groupa", "groupb", "groupc", "groupd"])
+
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as pgs:
+			pgs.removeStandAloneGroup("groupa")
+
+		with PasswdGroupShadow(self.rootDir, useCache=True) as pgs3:
+			self.assertIsNot(pgs1.pwdDict, pgs3.pwdDict)
+			self.assertEqual(pgs3.getStandAloneGroupList(), ["groupb", "groupc"])
+
+		# state cached by a lazy instance is completed and verified by a non-lazy one
+		shadowFile = os.path.join(self.rootDir, "etc", "shadow")
+		with open(shadowFile) as f:
+			lineList = [x for x in f.read().split("\n") if not x.startswith("userb:")]
+		with open(shadowFile, "w") as f:
+			f.write("\n".join(lineList))
+		with PasswdGroupShadow(self.rootDir, useCache=True, lazy=True) as pgs4:
+			self.assertNotIn("shDict", pgs4.__dict__)
+		with self.assertRaisesRegex(strict_pgs.PgsFormatError, "No shadow entry for normal user userb"):
+			PasswdGroupShadow(self.rootDir, useCache=True)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+		strict_pgs.clearStateCache()
+
+class LazyLoad(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		shadowFile = os.path.join(self.rootDir, "etc", "shadow")
+		with open(shadowFile) as f:
+			lineList = [x for x in f.read().split("\n") if not x.startswith("userb:")]
+		with open(shadowFile, "w") as f:
+			f.write("\n".join(lineList))
+
+		with PasswdGroupShadow(self.rootDir, lazy=True) as pgs:
+			self.assertEqual(pgs.getNormalUserList(), ["usera", "userb"])
+			self.assertEqual(pgs.getSecondaryGroupsOfUser("usera"), ["groupa", "groupb", "groupc"])
+			self.assertNotIn("shDict", pgs.__dict__)
+			with self.assertRaises(strict_pgs.PgsFormatError):
+				pgs.verify()
+			with self.assertRaisesRegex(strict_pgs.PgsFormatError, "No shadow entry for normal user userb"):
+				pgs.verify()
+			self.assertIn("No shadow entry for normal user userb", [x.message for x in pgs.check()])
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class LazyModify(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		with PasswdGroupShadow(self.rootDir, readOnly=False, lazy=True) as pgs:
+			self.assertNotIn("shDict", pgs.__dict__)
+			pgs.addNormalUser("userc", "password")
+			pgs.removeNormalUser("userb")
+			self.assertEqual(pgs.lazyTableSet, set())
+
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			self.assertEqual(pgs.getNormalUserList(), ["usera", "userc"])
+			self.assertIn("userc", pgs.shDict)
+			self.assertIn("userc", pgs.subUidDict)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class ParseErrorLineNumber(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		with open(os.path.join(self.rootDir, "etc", "group"), "a") as f:
+			f.write("groupd:x:notanumber:\n")
+		with self.assertRaisesRegex(strict_pgs.PgsFormatError, "group file, line 24$"):
+			PasswdGroupShadow(self.rootDir)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class LoginDefsModel(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-empty")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		loginDefFile = os.path.join(self.rootDir, "etc", "login.defs")
+		defs = strict_pgs.getLoginDefs(loginDefFile)
+		self.assertEqual(defs["UID_MIN"], 1000)
+		self.assertEqual(defs["UMASK"], 0o22)
+		self.assertEqual(defs["USERGROUPS_ENAB"], True)
+
+		with open(loginDefFile, "a") as f:
+			f.write("ENCRYPT_METHOD SHA256\nSHA_CRYPT_MIN_ROUNDS 6000\nSHA_CRYPT_MAX_ROUNDS 6000\n")
+		self.assertEqual(strict_pgs.getLoginDefs(loginDefFile)["ENCRYPT_METHOD"], "SHA256")
+
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as pgs:
+			pgs.addNormalUser("usera", "password")
+		with open(os.path.join(self.rootDir, "etc", "shadow")) as f:
+			self.assertIn("usera:$5$rounds=6000$", f.read())
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class LockContention(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False)
+		self.assertEqual(pgs.lockRetries, 0)
+		try:
+			# lockf() locks are per process, so contention must come from another process
+			code = "import sys; sys.path.insert(0, %r); import strict_pgs; " % (os.path.join(curDir, "../python3"))
+			code += "sys.exit(0 if strict_pgs.PasswdGroupShadow.tryOpen(%r) is None else 1)" % (self.rootDir)
+			self.assertEqual(subprocess.call([sys.executable, "-W", "ignore", "-c", code]), 0)
+			code = "import sys; sys.path.insert(0, %r); import strict_pgs\n" % (os.path.join(curDir, "../python3"))
+			code += "try:\n    strict_pgs.PasswdGroupShadow(%r, readOnly=False, lockTimeout=0.05)\n" % (self.rootDir)
+			code += "except strict_pgs.PgsLockError:\n    sys.exit(0)\nsys.exit(1)\n"
+			self.assertEqual(subprocess.call([sys.executable, "-W", "ignore", "-c", code]), 0)
+		finally:
+			pgs.close()
+
+		pgs = PasswdGroupShadow.tryOpen(self.rootDir)
+		self.assertIsNotNone(pgs)
+		pgs.close()
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class SnapshotRead(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		rootDir = self.rootDir
+
+		class _Pgs(PasswdGroupShadow):
+			replaced = False
+
+			def _parseShadow(self):
+				# simulate a commit of another process between parsing passwd and shadow
+				if not _Pgs.replaced:
+					shadowFile = os.path.join(rootDir, "etc", "shadow")
+					shutil.copy2(shadowFile, shadowFile + "+")
+					os.rename(shadowFile + "+", shadowFile)
+					_Pgs.replaced = True
+				super()._parseShadow()
+
+		with _Pgs(self.rootDir, snapshot=True) as pgs:
+			self.assertEqual(pgs.snapshotRetries, 1)
+			self.assertEqual(pgs.getNormalUserList(), ["usera", "userb"])
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class OptimisticCommit(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False, optimistic=True)
+		pgs.addNormalUser("userc", "password")
+		encpwd = pgs.shDict["userc"].sh_encpwd
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as other:
+			other.addStandAloneGroup("groupx")
+		pgs.close()
+
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			self.assertIn("userc", pgs.getNormalUserList())
+			self.assertIn("groupx", pgs.getStandAloneGroupList())
+			self.assertEqual(pgs.shDict["userc"].sh_encpwd, encpwd)
+
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False, optimistic=True)
+		pgs.addStandAloneGroup("groupy")
+		groupList = pgs.getStandAloneGroupList()
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as other:
+			other.addStandAloneGroup("groupy")
+			other.addStandAloneGroup("groupz")
+		with self.assertRaises(strict_pgs.PgsConflictError):
+			pgs.close()
+		self.assertEqual(pgs.opLog, [("addStandAloneGroup", ("groupy",))])
+		self.assertEqual(pgs.getStandAloneGroupList(), groupList)
+
+		# writing fails after rebasing, the state before rebasing is rolled back to and rebased again next time
+		def failWrite():
+			raise OSError("write failed")
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False, optimistic=True)
+		baseIdentity = pgs.baseIdentity
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as other:
+			other.addStandAloneGroup("groupw")
+		pgs._writeSubGid = failWrite
+		with self.assertRaises(OSError):
+			with pgs.batch():
+				pgs.addStandAloneGroup("groupv")
+		self.assertEqual(pgs.baseIdentity, baseIdentity)
+		self.assertNotIn("groupw", pgs.getStandAloneGroupList())
+		del pgs._writeSubGid
+		with pgs.batch():
+			pgs.addStandAloneGroup("groupv")
+		pgs.close()
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			self.assertIn("groupw", pgs.getStandAloneGroupList())
+			self.assertIn("groupv", pgs.getStandAloneGroupList())
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class AsyncFrontEnd(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		async def _main():
+			pgs = await strict_pgs.AsyncPasswdGroupShadow.open(self.rootDir, readOnly=False)
+			async with pgs:
+				async with pgs.batch():
+					await pgs.addNormalUser("userc", "password")
+					await pgs.addStandAloneGroup("groupx")
+				with self.assertRaises(strict_pgs.PgsAddGroupError):
+					async with pgs.batch():
+						await pgs.addStandAloneGroup("groupy")
+						raise strict_pgs.PgsAddGroupError("rollback")
+				userList, groupList = await asyncio.gather(pgs.getNormalUserList(), pgs.getStandAloneGroupList())
+				self.assertIn("userc", userList)
+				self.assertIn("groupx", groupList)
+				self.assertNotIn("groupy", groupList)
+
+				# tasks gathered inside a batch belong to it
+				async with pgs.batch():
+					await asyncio.wait_for(asyncio.gather(pgs.addStandAloneGroup("group1"), pgs.addStandAloneGroup("group2")), 10)
+				self.assertTrue({"group1", "group2"} <= set(await pgs.getStandAloneGroupList()))
+
+			# queries parsing a table in lazy mode are run in a thread
+			async with await strict_pgs.AsyncPasswdGroupShadow.open(self.rootDir, lazy=True) as pgs:
+				loopThread = threading.get_ident()
+				parseThreadList = []
+				loadTable = pgs.pgs._loadTable
+				pgs.pgs._loadTable = lambda table: (parseThreadList.append(threading.get_ident()), loadTable(table))[1]
+				owner = await pgs.ownerOfSubUid(100000)
+				self.assertEqual(owner, await pgs.ownerOfSubUid(100000))
+				self.assertNotEqual(parseThreadList, [])
+				self.assertNotIn(loopThread, parseThreadList)
+
+			async with await strict_pgs.AsyncPasswdGroupShadow.open(self.rootDir) as pgs:
+				self.assertIn("userc", await pgs.getNormalUserList())
+
+			# cancelled while parsing in the thread, the object opened is closed and the lock is released
+			task = asyncio.ensure_future(strict_pgs.AsyncPasswdGroupShadow.open(self.rootDir, readOnly=False))
+			await asyncio.sleep(0)
+			task.cancel()
+			with self.assertRaises(asyncio.CancelledError):
+				await task
+			code = "import sys; sys.path.insert(0, %r); import strict_pgs; " % (os.path.join(curDir, "../python3"))
+			code += "sys.exit(0 if strict_pgs.PasswdGroupShadow.tryOpen(%r) is not None else 1)" % (self.rootDir)
+			self.assertEqual(subprocess.call([sys.executable, "-W", "ignore", "-c", code]), 0)
+
+		asyncio.run(_main())
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class CheckAllProblems(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-need-convert")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			problemList = pgs.check()
+			self.assertGreater(len(problemList), 1)
+			self.assertTrue(all(x.stage == 3 and x.fixable for x in problemList))
+			self.assertIn("gshadow file should be empty", [x.message for x in problemList])
+			self.assertIn("news", [x.entity for x in problemList])
+			with self.assertRaisesRegex(strict_pgs.PgsFormatError, "^%s$" % (problemList[0].message)):
+				pgs.verify()
+
+		PasswdGroupShadow(self.rootDir, readOnly=False).close()
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			self.assertEqual(pgs.check(), [])
+
+		# committing doesn't remove a user from a deprecated group
+		groupFile = os.path.join(self.rootDir, "etc", "group")
+		with open(groupFile) as f:
+			buf = re.sub("^sys:x:3:.*$", "sys:x:3:usera", f.read(), flags=re.M)
+		with open(groupFile, "w") as f:
+			f.write(buf)
+		problem = strict_pgs.PgsVerifyProblem(3, False, "usera", "User usera is a member of deprecated group sys")
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			self.assertEqual(pgs.check(), [problem])
+		PasswdGroupShadow(self.rootDir, readOnly=False).close()
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			self.assertEqual(pgs.check(), [problem])
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class IncrementalVerify(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-need-convert")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		PasswdGroupShadow(self.rootDir, readOnly=False).close()
+
+		opList = [
+			lambda pgs: pgs.addNormalUser("newusera", "password"),
+			lambda pgs: pgs.addNormalUser("newuserb", "password"),
+			lambda pgs: pgs.addStandAloneGroup("newgroupa"),
+			lambda pgs: pgs.modifyNormalUser("newusera", MUSER_JOIN_GROUP, "newgroupa"),
+			lambda pgs: pgs.removeNormalUser("newusera"),
+			lambda pgs: pgs.addNormalUser("newuserc", "password"),
+			lambda pgs: pgs.removeStandAloneGroup("newgroupa"),
+			lambda pgs: pgs.modifyNormalUser("newuserb", strict_pgs.MUSER_SET_PASSWORD, "password2"),
+		]
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as pgs:
+			pgs.verify()
+			for op in opList:
+				op(pgs)
+				self.assertNotEqual(pgs.touchedUserSet | pgs.touchedGroupSet, set())
+				messageList = [x.message for x in pgs.check()]
+				try:
+					pgs.verify()
+					self.assertEqual(messageList, [])
+					self.assertEqual(pgs.touchedUserSet | pgs.touchedGroupSet, set())
+				except strict_pgs.PgsFormatError as e:
+					self.assertIn(str(e), messageList)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class ReverseLookup(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as pgs:
+			self.assertEqual(pgs.getUserByUid(0), "root")
+			self.assertEqual(pgs.getGroupByGid(5000), "groupa")
+			self.assertEqual(pgs.resolveUids([1000, 1001, 99999]), {1000: "usera", 1001: "userb", 99999: None})
+
+			pgs.removeNormalUser("usera")
+			pgs.removeStandAloneGroup("groupa")
+			self.assertIsNone(pgs.getUserByUid(1000))
+			self.assertEqual(pgs.resolveGids([1000, 5000]), {1000: None, 5000: None})
+
+			pgs.addNormalUser("userc", "password")
+			pgs.addStandAloneGroup("groupd")
+			uid = pgs.pwdDict["userc"].pw_uid
+			self.assertEqual(pgs.getUserByUid(uid), "userc")
+			self.assertEqual(pgs.getGroupByGid(uid), "userc")
+			self.assertEqual(pgs.getGroupByGid(pgs.grpDict["groupd"].gr_gid), "groupd")
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class QueryIndexes(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as pgs:
+			self.assertEqual(pgs.queryUsers(category="normal", shell="/bin/bash"), {"usera", "userb"})
+			self.assertEqual(pgs.queryUsers(homePrefix="/home/"), {"usera", "userb"})
+			self.assertEqual(pgs.queryUsers(groups=["groupa", "groupb"]), {"usera"})
+			self.assertEqual(pgs.queryUsers(anyGroups=["groupa", "wheel"], category="system"), set())
+			self.assertEqual(pgs.queryGroups(category="stand-alone", member="usera"), {"groupa", "groupb", "groupc"})
+
+			pgs.addNormalUser("userc", "password")
+			pgs.modifyNormalUser("userc", MUSER_JOIN_GROUP, "groupb")
+			self.assertEqual(pgs.queryUsers(homePrefix="/home/userc"), {"userc"})
+			self.assertEqual(pgs.queryUsers(groups=["groupb"]), {"usera", "userc"})
+			self.assertEqual(pgs.getSecondaryGroupsOfUser("userc"), ["groupb"])
+
+			pgs.modifyNormalUser("userc", MUSER_LEAVE_GROUP, "groupb")
+			self.assertEqual(pgs.getSecondaryGroupsOfUser("userc"), [])
+			pgs.removeNormalUser("userc")
+			self.assertEqual(pgs.queryUsers(shell="/bin/bash", category="normal"), {"usera", "userb"})
+
+		# members which are not users are not returned
+		groupFile = os.path.join(self.rootDir, "etc", "group")
+		with open(groupFile) as f:
+			buf = f.read().replace("groupc:x:5002:usera\n", "groupc:x:5002:usera,ghost\n")
+		with open(groupFile, "w") as f:
+			f.write(buf)
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			self.assertIn("ghost", pgs.groupMemberDict["groupc"])
+			self.assertEqual(pgs.queryUsers(groups=["groupc"]), {"usera"})
+			self.assertEqual(pgs.queryUsers(anyGroups=["groupc"]), {"usera"})
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class SubIdOwner(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		# subuid and subgid entries are allocated when saving
+		PasswdGroupShadow(self.rootDir, readOnly=False).close()
+
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as pgs:
+			e = pgs.subUidDict["usera"]
+			self.assertEqual(pgs.ownerOfSubUid(e.start), "usera")
+			self.assertEqual(pgs.ownerOfSubUid(e.start + e.count - 1), "usera")
+			self.assertIsNone(pgs.ownerOfSubUid(pgs.subUidMin - 1))
+			self.assertEqual(pgs.findSubUidOverlaps(e.start + e.count - 1, 2), {"usera", pgs.ownerOfSubUid(e.start + e.count)} - {None})
+
+			pgs.removeNormalUser("usera")
+			self.assertIsNone(pgs.ownerOfSubUid(e.start))
+			pgs.addNormalUser("userc", "password")
+			e = pgs.subGidDict["userc"]
+			self.assertEqual(pgs.ownerOfSubGid(e.start), "userc")
+			self.assertEqual(pgs.findSubGidOverlaps(e.start, e.count), {"userc"})
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class ExportCdb(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		passwdCdbFile = os.path.join(self.rootDir, "etc", "passwd.cdb")
+		groupCdbFile = os.path.join(self.rootDir, "etc", "group.cdb")
+
+		with PasswdGroupShadow(self.rootDir, readOnly=False, cdbExport=True) as pgs:
+			pgs.addNormalUser("userc", "password")
+			uid = pgs.pwdDict["userc"].pw_uid
+		with strict_pgs._CdbReader(passwdCdbFile) as db:
+			self.assertEqual(db.get(".userc"), "userc:x:%d:%d::/home/userc:/bin/bash" % (uid, uid))
+			self.assertEqual(db.get("=0"), "root:x:0:0::/root:/bin/bash")
+			self.assertIsNone(db.get(".nonexist"))
+		with strict_pgs._CdbReader(groupCdbFile) as db:
+			self.assertEqual(db.get(".groupa"), "groupa:x:5000:usera")
+			self.assertEqual(db.get("=5001"), "groupb:x:5001:usera")
+			self.assertEqual(db.get(":usera"), "groupa,groupb,groupc")
+
+		# nothing changed, not re-generated
+		ino = os.stat(passwdCdbFile).st_ino
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			pgs.exportCdb()
+		self.assertEqual(os.stat(passwdCdbFile).st_ino, ino)
+
+		with PasswdGroupShadow(self.rootDir, readOnly=False, cdbExport=True) as pgs:
+			pgs.removeNormalUser("userc")
+		self.assertNotEqual(os.stat(passwdCdbFile).st_ino, ino)
+		with strict_pgs._CdbReader(passwdCdbFile) as db:
+			self.assertIsNone(db.get(".userc"))
+
+		# a read-only instance modified in memory doesn't reflect the account files
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			pgs.addStandAloneGroup("ghost")
+			with self.assertRaises(AssertionError):
+				pgs.exportCdb()
+
+		# exporting fails after the commit, which is neither rolled back nor keeps the lock
+		os.unlink(passwdCdbFile)
+		os.mkdir(passwdCdbFile)
+		pgs = PasswdGroupShadow(self.rootDir, readOnly=False, cdbExport=True)
+		with self.assertRaises(strict_pgs.PgsCdbExportError):
+			with pgs.batch():
+				pgs.addNormalUser("userd", "password")
+		self.assertIn("userd", pgs.getNormalUserList())
+		with self.assertRaises(strict_pgs.PgsCdbExportError):
+			pgs.close()
+		with PasswdGroupShadow(self.rootDir, readOnly=False, lockTimeout=0) as pgs:
+			self.assertIn("userd", pgs.getNormalUserList())
+		os.rmdir(passwdCdbFile)
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
+class MappedOpen(unittest.TestCase):
+	def setUp(self):
+		self.srcDir = os.path.join(curDir, "data-full")
+		self.rootDir = os.path.join(curDir, "test")
+		shutil.copytree(self.srcDir, self.rootDir)
+
+	def runTest(self):
+		# no cdb file, fall back to parsing
+		with PasswdGroupShadow.openMapped(self.rootDir) as pgs:
+			self.assertIsInstance(pgs, PasswdGroupShadow)
+
+		PasswdGroupShadow(self.rootDir, readOnly=False, cdbExport=True).close()
+		with PasswdGroupShadow(self.rootDir) as pgs, PasswdGroupShadow.openMapped(self.rootDir) as mpgs:
+			self.assertIsInstance(mpgs, strict_pgs.MappedPasswdGroupShadow)
+			self.assertEqual(mpgs.getNormalUserList(), pgs.getNormalUserList())
+			self.assertEqual(mpgs.getSystemGroupList(), pgs.getSystemGroupList())
+			self.assertEqual(mpgs.getStandAloneGroupList(), pgs.getStandAloneGroupList())
+			self.assertEqual(mpgs.getSecondaryGroupsOfUser("usera"), pgs.getSecondaryGroupsOfUser("usera"))
+			self.assertEqual(mpgs.resolveUids([0, 1000, 99999]), pgs.resolveUids([0, 1000, 99999]))
+			self.assertEqual(mpgs.getGroupByGid(5002), "groupc")
+			self.assertEqual(mpgs.queryUsers(), pgs.queryUsers())
+			self.assertEqual(mpgs.queryUsers(category="normal", shell="/bin/bash"), pgs.queryUsers(category="normal", shell="/bin/bash"))
+			self.assertEqual(mpgs.queryUsers(homePrefix="/home/"), pgs.queryUsers(homePrefix="/home/"))
+			self.assertEqual(mpgs.queryUsers(groups=["groupa", "groupb"]), pgs.queryUsers(groups=["groupa", "groupb"]))
+			self.assertEqual(mpgs.queryUsers(anyGroups=["groupa", "wheel"]), pgs.queryUsers(anyGroups=["groupa", "wheel"]))
+			self.assertEqual(mpgs.queryGroups(), pgs.queryGroups())
+			self.assertEqual(mpgs.queryGroups(category="stand-alone", member="usera"), pgs.queryGroups(category="stand-alone", member="usera"))
+			self.assertEqual(mpgs.queryGroups(member="nobody"), set())
+
+			# same behavior for what only one of them supports
+			with self.assertRaises(AssertionError):
+				pgs.getSecondaryGroupsOfUser("root")
+			with self.assertRaises(AssertionError):
+				mpgs.getSecondaryGroupsOfUser("root")
+			with self.assertRaises(NotImplementedError):
+				mpgs.ownerOfSubUid(100000)
+			with self.assertRaises(NotImplementedError):
+				mpgs.check()
+
+		# account files are changed, the cdb files are out of date
+		with PasswdGroupShadow(self.rootDir, readOnly=False) as pgs:
+			pgs.addNormalUser("userc", "password")
+		with PasswdGroupShadow.openMapped(self.rootDir) as pgs:
+			self.assertIsInstance(pgs, PasswdGroupShadow)
+			self.assertIn("userc", pgs.getNormalUserList())
+
+		# secondary groups are right when groups share a gid
+		with open(os.path.join(self.rootDir, "etc", "group"), "a") as f:
+			f.write("groupd:x:5002:usera\n")
+		with PasswdGroupShadow(self.rootDir) as pgs:
+			pgs.exportCdb()
+			with PasswdGroupShadow.openMapped(self.rootDir) as mpgs:
+				self.assertIsInstance(mpgs, strict_pgs.MappedPasswdGroupShadow)
+				self.assertEqual(mpgs.getSecondaryGroupsOfUser("usera"), ["groupa", "groupb", "groupc", "groupd"])
+				self.assertEqual(mpgs.getSecondaryGroupsOfUser("usera"), pgs.getSecondaryGroupsOfUser("usera"))
+
+	def tearDown(self):
+		shutil.rmtree(self.rootDir)
+
 def suite():
 	suite = unittest.TestSuite()
 	suite.addTest(ReadDataEmpty())
@@ -127,6 +974,29 @@ def suite():
 	suite.addTest(ReadDataNeedConvert())
 	suite.addTest(ConvertAndSave())
 #	suite.addTest(AddOneNormalUser())
+	suite.addTest(AllocateIds())
+	suite.addTest(BatchCommitAndRollback())
+	suite.addTest(ReplaceFilesFailure())
+	suite.addTest(ParallelPasswordHashing())
+	suite.addTest(ModifyGroupMembers())
+	suite.addTest(AtomicCommit())
+	suite.addTest(WriteChangedFilesOnly())
+	suite.addTest(CachedReadOnlyOpen())
+	suite.addTest(LazyLoad())
+	suite.addTest(LazyModify())
+	suite.addTest(ParseErrorLineNumber())
+	suite.addTest(LoginDefsModel())
+	suite.addTest(LockContention())
+	suite.addTest(SnapshotRead())
+	suite.addTest(OptimisticCommit())
+	suite.addTest(AsyncFrontEnd())
+	suite.addTest(CheckAllProblems())
+	suite.addTest(IncrementalVerify())
+	suite.addTest(ReverseLookup())
+	suite.addTest(QueryIndexes())
+	suite.addTest(SubIdOwner())
+	suite.addTest(ExportCdb())
+	suite.addTest(MappedOpen())
 	return suite
 
 if __name__ == "__main__":
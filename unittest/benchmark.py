@@ -0,0 +1,225 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8; tab-width: 4; indent-tabs-mode: t -*-
+
+# Scaling benchmark for PasswdGroupShadow.
+#
+# For every database size a synthetic etc/ tree is generated in a temporary
+# directory, then the following phases are timed in a child process:
+#   open    PasswdGroupShadow.__init__ (parse + _verifyStage1), writable
+#   verify  verify()
+#   add     addNormalUser() loop
+#   remove  removeNormalUser() loop
+#   close   close() (_fixate + all _write*)
+# Wall time and peak RSS are reported for each phase.  Each size runs in its
+# own process so that peak memory is not polluted by the previous size and so
+# that a quadratic phase can be cut off by --timeout.
+#
+# Usage: benchmark.py [--sizes 1000,10000,...] [--ops N] [--timeout SECONDS] [--json]
+
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import subprocess
+
+curDir = os.path.dirname(os.path.abspath(__file__))
+if sys.version_info >= (3, 0):
+	sys.path.insert(0, os.path.join(curDir, "../python3"))
+else:
+	sys.path.insert(0, os.path.join(curDir, "../python2"))
+
+defaultSizes = [1000, 10000, 100000, 1000000]
+phaseList = ["open", "verify", "add", "remove", "close"]
+
+idMin = 1000
+subIdMin = 100000
+subIdCount = 65536
+softwareUserList = [("sshd", 22), ("messagebus", 101), ("portage", 250)]
+
+
+def generateTree(rootDir, size, ops):
+	"""generate an etc/ tree with size normal users and size stand-alone groups, which passes verify()"""
+
+	etcDir = os.path.join(rootDir, "etc")
+	os.makedirs(etcDir)
+
+	# login.defs, ranges are enlarged to hold the synthetic accounts
+	uidMax = idMin + 2 * size + ops + 1000
+	subIdMax = subIdMin + subIdCount * (size + len(softwareUserList) + ops + 1000)
+	with open(os.path.join(curDir, "data-empty", "etc", "login.defs")) as f:
+		buf = f.read()
+	for key, value in [("UID_MAX", uidMax), ("GID_MAX", uidMax),
+					   ("SUB_UID_MIN", subIdMin), ("SUB_UID_MAX", subIdMax), ("SUB_UID_COUNT", subIdCount),
+					   ("SUB_GID_MIN", subIdMin), ("SUB_GID_MAX", subIdMax), ("SUB_GID_COUNT", subIdCount)]:
+		buf = re.sub(r'^%s\s+[0-9]+\s*$' % (key), "%s\t\t%d" % (key, value), buf, flags=re.M)
+	with open(os.path.join(etcDir, "login.defs"), "w") as f:
+		f.write(buf)
+
+	encpwd = "$6$XXXXXXXX$" + "X" * 86
+	userList = ["user%07d" % (i) for i in range(0, size)]
+	groupList = ["group%07d" % (i) for i in range(0, size)]
+
+	with open(os.path.join(etcDir, "passwd"), "w") as f:
+		f.write("root:x:0:0::/root:/bin/bash\n")
+		f.write("nobody:x:65534:65534::/var/empty:/bin/false\n")
+		for i, uname in enumerate(userList):
+			f.write("%s:x:%d:%d::/home/%s:/bin/bash\n" % (uname, idMin + i, idMin + i, uname))
+		for uname, uid in softwareUserList:
+			f.write("%s:x:%d:%d::/var/empty:/sbin/nologin\n" % (uname, uid, uid))
+
+	with open(os.path.join(etcDir, "group"), "w") as f:
+		f.write("root:x:0:\n")
+		f.write("nobody:x:65534:\n")
+		f.write("nogroup:x:65533:\n")
+		f.write("wheel:x:1:\n")
+		f.write("users:x:2:\n")
+		for i, uname in enumerate(userList):
+			f.write("%s:x:%d:\n" % (uname, idMin + i))
+		for i, gname in enumerate(groupList):
+			f.write("%s:x:%d:%s\n" % (gname, idMin + size + i, userList[i]))
+		for uname, uid in softwareUserList:
+			f.write("%s:x:%d:\n" % (uname, uid))
+
+	with open(os.path.join(etcDir, "shadow"), "w") as f:
+		f.write("root:%s:::::::\n" % (encpwd))
+		f.write("nobody:*:::::::\n")
+		for uname in userList:
+			f.write("%s:%s:::::::\n" % (uname, encpwd))
+
+	with open(os.path.join(etcDir, "gshadow"), "w") as f:
+		pass
+
+	for fn in ["subuid", "subgid"]:
+		with open(os.path.join(etcDir, fn), "w") as f:
+			i = 0
+			for uname in userList + [x[0] for x in softwareUserList]:
+				f.write("%s:%d:%d\n" % (uname, subIdMin + i * subIdCount, subIdCount))
+				i += 1
+
+
+def resetPeakRss():
+	# writing "5" to clear_refs resets VmHWM, see proc(5)
+	try:
+		with open("/proc/self/clear_refs", "w") as f:
+			f.write("5")
+	except OSError:
+		pass
+
+
+def getPeakRss():
+	"""returns peak resident set size in bytes"""
+	with open("/proc/self/status") as f:
+		for line in f:
+			if line.startswith("VmHWM:"):
+				return int(line.split()[1]) * 1024
+	return -1
+
+
+def runOneSize(size, ops):
+	"""run all the phases for one size, print one json line per phase as soon as it completes"""
+
+	from strict_pgs import PasswdGroupShadow
+
+	rootDir = tempfile.mkdtemp(prefix="strict_pgs_bench_")
+	try:
+		generateTree(rootDir, size, ops)
+		newUserList = ["newuser%07d" % (i) for i in range(0, ops)]
+		state = dict()
+
+		def _open():
+			state["pgs"] = PasswdGroupShadow(rootDir, readOnly=False)
+
+		def _verify():
+			state["pgs"].verify()
+
+		def _add():
+			for uname in newUserList:
+				state["pgs"].addNormalUser(uname, "password")
+
+		def _remove():
+			for uname in newUserList:
+				state["pgs"].removeNormalUser(uname)
+
+		def _close():
+			state["pgs"].close()
+
+		for phase, func in zip(phaseList, [_open, _verify, _add, _remove, _close]):
+			resetPeakRss()
+			t = time.perf_counter()
+			try:
+				func()
+				error = None
+			except Exception as e:
+				error = "%s: %s" % (e.__class__.__name__, e)
+			result = {
+				"size": size,
+				"phase": phase,
+				"seconds": time.perf_counter() - t,
+				"peak_rss": getPeakRss(),
+				"error": error,
+			}
+			print(json.dumps(result), flush=True)
+			if error is not None:
+				break
+	finally:
+		shutil.rmtree(rootDir)
+
+
+def runSizeInChild(size, ops, timeout):
+	cmd = [sys.executable, os.path.abspath(__file__), "--run-one", str(size), "--ops", str(ops)]
+	try:
+		out = subprocess.run(cmd, stdout=subprocess.PIPE, universal_newlines=True, timeout=timeout).stdout
+		timedOut = False
+	except subprocess.TimeoutExpired as e:
+		out = e.stdout or ""
+		if isinstance(out, bytes):
+			out = out.decode()
+		timedOut = True
+
+	resultList = [json.loads(x) for x in out.split("\n") if x != ""]
+	if timedOut and len(resultList) < len(phaseList):
+		resultList.append({"size": size, "phase": phaseList[len(resultList)], "seconds": None, "peak_rss": None, "error": "timeout"})
+	return resultList
+
+
+def printResult(r):
+	if r["seconds"] is None:
+		t = "-"
+	else:
+		t = "%.3f" % (r["seconds"])
+	if r["peak_rss"] is None:
+		m = "-"
+	else:
+		m = "%.1f" % (r["peak_rss"] / 1024 / 1024)
+	print("%10d  %-8s %12s %12s  %s" % (r["size"], r["phase"], t, m, r["error"] or ""), flush=True)
+
+
+if __name__ == "__main__":
+	parser = argparse.ArgumentParser(description="Scaling benchmark for strict_pgs.")
+	parser.add_argument("--sizes", default=",".join([str(x) for x in defaultSizes]),
+						help="comma separated list of database sizes (default: %(default)s)")
+	parser.add_argument("--ops", type=int, default=10,
+						help="number of users added and then removed in the add/remove phases (default: %(default)s)")
+	parser.add_argument("--timeout", type=float, default=1800,
+						help="time budget in seconds for all the phases of one size (default: %(default)s)")
+	parser.add_argument("--json", action="store_true",
+						help="print raw json lines instead of a table")
+	parser.add_argument("--run-one", type=int, default=None, help=argparse.SUPPRESS)
+	args = parser.parse_args()
+
+	if args.run_one is not None:
+		runOneSize(args.run_one, args.ops)
+		sys.exit(0)
+
+	if not args.json:
+		print("%10s  %-8s %12s %12s  %s" % ("size", "phase", "seconds", "peak-MiB", "error"))
+	for size in [int(x) for x in args.sizes.split(",")]:
+		for r in runSizeInChild(size, args.ops, args.timeout):
+			if args.json:
+				print(json.dumps(r), flush=True)
+			else:
+				printResult(r)